@@ -0,0 +1,505 @@
+import argparse
+import copy
+import errno
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import ipsetpy.wrapper
+import IpRanges
+from collections import Counter
+from BlockFile import BlockFile
+from Firewall import IptablesBackend
+from ListActions import FeedFetcher, configured_feeds
+from Metrics import metrics
+from Nftables import NftablesBackend
+from Pipeline import apply_block_list, update_block_list
+
+DEFAULT_SCALES = "10000,100000,1000000"
+DEFAULT_SEED = 1
+CHANGED_SHARE = 0.01
+CHECK_LOOKUPS = 100000
+SERVER_START_TIMEOUT = 10
+# ipset options followed by a value, which must not be taken for a set name.
+IPSET_VALUE_OPTIONS = ("-output", "-o", "-file", "-f")
+backends = {"iptables": IptablesBackend, "nftables": NftablesBackend}
+
+
+class RecordingCommands:
+    '''
+    In-process stand-in for ipset, iptables, ip6tables, their -save and -restore tools, nft and ip. It keeps just
+    enough state (ipsets with their entries, chains with their rules, nft tables) for the backends to take the same
+    code paths as on a real bridge, and counts every call and every line sent on stdin. Nothing is executed, so the
+    benchmark measures Phalanx itself and runs without root.
+    '''
+    def __init__(self):
+        self.sets = {}
+        self.chains = {"iptables": {}, "ip6tables": {}}
+        self.tables = {}
+        self.calls = Counter()
+        self.input_lines = Counter()
+
+    def install(self):
+        '''
+        Routes Metrics.run and ipsetpy through this recorder.
+        '''
+        metrics.runner = self.run
+        ipsetpy.wrapper.subprocess = types.SimpleNamespace(Popen=lambda args, **kwargs: FakeProcess(self, args),
+                                                           PIPE=subprocess.PIPE,
+                                                           TimeoutExpired=subprocess.TimeoutExpired)
+
+    def uninstall(self):
+        metrics.runner = subprocess.run
+        ipsetpy.wrapper.subprocess = subprocess
+
+    def reboot(self):
+        '''
+        Forgets all ipsets and rules, like a freshly booted kernel.
+        '''
+        self.sets = {}
+        self.chains = {"iptables": {}, "ip6tables": {}}
+        self.tables = {}
+
+    def state(self):
+        '''
+        Returns a copy of the fake kernel state, to check that a restored snapshot matches what was saved.
+        '''
+        return copy.deepcopy((self.sets, self.chains, self.tables))
+
+    def reset_counts(self):
+        self.calls.clear()
+        self.input_lines.clear()
+
+    def run(self, args, input=None, capture_output=False, **kwargs):
+        '''
+        subprocess.run replacement returning bytes like the real call does.
+        '''
+        returncode, stdout, stderr = self.execute(args, input.decode("utf-8") if input is not None else "")
+        return subprocess.CompletedProcess(args, returncode, stdout.encode("utf-8"), stderr.encode("utf-8"))
+
+    def execute(self, args, stdin):
+        command = os.path.basename(args[0])
+        self.calls[command] += 1
+        self.input_lines[command] += stdin.count("\n")
+        if command == "ipset":
+            return self.ipset(list(args[1:]), stdin)
+        if command in self.chains:
+            return self.iptables(self.chains[command], list(args[1:]))
+        if command.endswith("-save"):
+            return self.save(self.chains[command[:-len("-save")]])
+        if command.endswith("-restore"):
+            return self.restore(self.chains[command[:-len("-restore")]], stdin, "--noflush" not in args)
+        if command == "nft":
+            return self.nft(list(args[1:]), stdin)
+        return 0, "", ""
+
+    def ipset(self, args, stdin):
+        if args[0] == "restore":
+            for number, line in enumerate(stdin.splitlines(), 1):
+                error = self.ipset_restore_line(line.split())
+                if error:
+                    return 1, "", restore_error(number, error)
+            return 0, "", ""
+        names = []
+        arguments = iter(args[1:])
+        for arg in arguments:
+            if arg in IPSET_VALUE_OPTIONS:
+                next(arguments, None)
+            elif not arg.startswith("-"):
+                names.append(arg)
+        if names and names[0] not in self.sets:
+            return 1, "", "ipset v7.10: The set with the given name does not exist\n"
+        if args[0] == "list" and not names:
+            return 0, "".join("Name: " + name + "\n" for name in self.sets), ""
+        if args[0] == "list" and "-name" in args:
+            return 0, names[0] + "\n", ""
+        if args[0] == "list":
+            ip_set = self.sets[names[0]]
+            return 0, "Name: " + names[0] + "\nType: " + ip_set["type"] + "\nRevision: 7\nHeader: family " + \
+                      ip_set["family"] + "\nReferences: 0\nNumber of entries: " + str(len(ip_set["entries"])) + \
+                      "\n", ""
+        if args[0] == "save":
+            ip_set = self.sets[names[0]]
+            return 0, "create " + names[0] + " " + ip_set["type"] + " family " + ip_set["family"] + "\n" + \
+                      "".join("add " + names[0] + " " + entry + "\n" for entry in ip_set["entries"]), ""
+        if args[0] == "destroy":
+            del self.sets[names[0]]
+        elif args[0] == "swap":
+            self.sets[names[0]], self.sets[names[1]] = self.sets[names[1]], self.sets[names[0]]
+        return 0, "", ""
+
+    def ipset_restore_line(self, words):
+        if not words:
+            return None
+        if words[0] == "create":
+            if words[1] in self.sets and "-exist" not in words:
+                return "Set cannot be created: set with the same name already exists"
+            family = words[words.index("family") + 1] if "family" in words else "inet"
+            self.sets.setdefault(words[1], {"type": words[2], "family": family, "entries": set()})
+            return None
+        if words[1] not in self.sets:
+            return "The set with the given name does not exist"
+        if words[0] == "add":
+            self.sets[words[1]]["entries"].add(words[2])
+        elif words[0] == "del":
+            self.sets[words[1]]["entries"].discard(words[2])
+        return None
+
+    def nft(self, args, stdin):
+        '''
+        "nft list table" and "nft -f -" with the table declarations, deletions and definitions that Phalanx writes.
+        Table bodies are kept as text. Like the real nft, a file is applied as one transaction or not at all.
+        '''
+        if args[0] == "list":
+            if (args[2], args[3]) not in self.tables:
+                return 1, "", "Error: No such file or directory\n"
+            return 0, "table " + args[2] + " " + args[3] + " {\n" + self.tables[(args[2], args[3])] + "}\n", ""
+        tables = dict(self.tables)
+        lines = iter(stdin.splitlines())
+        for line in lines:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == "table" and words[-1] == "{":
+                body = []
+                depth = 1
+                for line in lines:
+                    depth += line.count("{") - line.count("}")
+                    if depth == 0:
+                        break
+                    body.append(line + "\n")
+                if depth != 0:
+                    return 1, "", "Error: syntax error, unexpected end of file\n"
+                tables[(words[1], words[2])] = "".join(body)
+            elif words[0] == "table":
+                tables.setdefault((words[1], words[2]), "")
+            elif words[:2] == ["delete", "table"] and (words[2], words[3]) in tables:
+                del tables[(words[2], words[3])]
+            else:
+                return 1, "", "Error: Could not process rule: " + line + "\n"
+        self.tables = tables
+        return 0, "", ""
+
+    @staticmethod
+    def iptables(chains, args):
+        option, chain, rule = args[0], args[1] if len(args) > 1 else "", " ".join(args[2:])
+        if option == "-S":
+            return 0, "".join("-A " + chain + " " + line + "\n" for line in chains.get(chain, [])), ""
+        if option == "-C":
+            return (0 if rule in chains.get(chain, []) else 1), "", ""
+        if option == "-A":
+            chains.setdefault(chain, []).append(rule)
+        elif option == "-D" and rule in chains.get(chain, []):
+            chains[chain].remove(rule)
+        elif option in ("-F", "-N"):
+            chains[chain] = []
+        return 0, "", ""
+
+    @staticmethod
+    def save(chains):
+        lines = ["*filter"] + [":" + chain + " - [0:0]" for chain in chains]
+        lines.extend("-A " + chain + " " + rule for chain, rules in chains.items() for rule in rules)
+        return 0, "\n".join(lines + ["COMMIT"]) + "\n", ""
+
+    @staticmethod
+    def restore(chains, stdin, flush):
+        if flush:
+            chains.clear()
+        for line in stdin.splitlines():
+            if line.startswith(":"):
+                chains.setdefault(line[1:].split(" ")[0], [])
+            elif line.startswith("-F "):
+                chains[line[3:]] = []
+            elif line.startswith("-A "):
+                chain, rule = line[3:].split(" ", 1)
+                chains.setdefault(chain, []).append(rule)
+        return 0, "", ""
+
+
+class FakeProcess:
+    '''
+    The part of subprocess.Popen that ipsetpy uses. stdin.write goes straight to the command: like the real ipset,
+    "ipset restore" applies each line as it arrives and exits at the first line it rejects, so writing to it after
+    that raises BrokenPipeError.
+    '''
+    def __init__(self, commands, args):
+        self.commands = commands
+        self.args = args
+        self.stdin = self
+        self.input = ""
+        self.lines = 0
+        self.stderr = ""
+        self.returncode = None
+        self.restore = list(args[1:2]) == ["restore"]
+
+    def write(self, text):
+        if self.returncode is not None:
+            raise BrokenPipeError(errno.EPIPE, "Broken pipe")
+        self.input += text
+        if self.restore:
+            *lines, self.input = self.input.split("\n")
+            for line in lines:
+                self.lines += 1
+                error = self.commands.ipset_restore_line(line.split())
+                if error:
+                    self.returncode = 1
+                    self.stderr = restore_error(self.lines, error)
+                    break
+        return len(text)
+
+    def communicate(self, timeout=None):
+        if not self.restore:
+            self.returncode, stdout, self.stderr = self.commands.execute(self.args, self.input)
+            return stdout, self.stderr
+        if self.returncode is None and self.input:
+            self.write("\n")
+        if self.returncode is None:
+            self.returncode = 0
+        self.commands.calls["ipset"] += 1
+        self.commands.input_lines["ipset"] += self.lines
+        return "", self.stderr
+
+    def kill(self):
+        pass
+
+
+def restore_error(number, error):
+    return "ipset v7.10: Error in line " + str(number) + ": " + error + "\n"
+
+
+class FeedServer:
+    '''
+    Serves a directory of feed files over HTTP on the loopback interface from a separate python -m http.server
+    process, which answers If-Modified-Since with 304 like the real feeds, without sharing the benchmark's CPU or
+    memory.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        self.process = subprocess.Popen([sys.executable, "-m", "http.server", str(port), "--bind", "127.0.0.1",
+                                         "--directory", self.directory], stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    self.process.kill()
+                    raise
+                time.sleep(0.05)
+        self.url = "http://127.0.0.1:" + str(port)
+        return self
+
+    def __exit__(self, *exception):
+        self.process.terminate()
+        self.process.wait()
+
+
+def random_ip(rng):
+    return IpRanges.int_to_ip(rng.getrandbits(32))
+
+
+def generate_feeds(directory, addresses, rng):
+    '''
+    Writes synthetic feeds in the formats of the three default feeds, together listing about addresses addresses:
+    45% single IPs in a Talos style list, 45% in an AlienVault OTX style list (a tenth of them shared with the Talos
+    list) and 10% as /24 netblocks in a DShield style table. Returns the feed declarations for config.json.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    talos_count = addresses * 45 // 100
+    shared = []
+    with open(os.path.join(directory, "talos.txt"), "w") as file:
+        for position in range(talos_count):
+            ip = random_ip(rng)
+            if position % 10 == 0:
+                shared.append(ip)
+            file.write(ip + "\n")
+    with open(os.path.join(directory, "otx.txt"), "w") as file:
+        file.write("# Synthetic AlienVault reputation list\n")
+        for ip in shared:
+            file.write(ip + " # Scanning Host,US,,0.0,0.0\n")
+        for position in range(addresses * 45 // 100 - len(shared)):
+            file.write(random_ip(rng) + " # Malicious Host,NL,Amsterdam,52.37,4.89\n")
+    with open(os.path.join(directory, "dshield.txt"), "w") as file:
+        file.write("#\n#   Synthetic DShield block list\n#\nStart\tEnd\tNetblock\tAttacks\tName\tCountry\temail\n")
+        for position in range(max(addresses // 10 // 256, 20)):
+            network = rng.getrandbits(24) << 8
+            file.write(IpRanges.int_to_ip(network) + "\t" + IpRanges.int_to_ip(network + 255) + "\t24\t" +
+                       str(rng.randint(100, 10000)) + "\tSynthetic\tUS\tabuse@example.com\n")
+    return [{"name": "dshield", "file": "dshield.txt", "format": "netblock"},
+            {"name": "cisco_talos", "file": "talos.txt", "format": "ip_list"},
+            {"name": "otx", "file": "otx.txt", "format": "comment_prefixed"}]
+
+
+def change_feed(path, share, rng):
+    '''
+    Replaces the first share of the lines of a plain IP list with new addresses and moves its modification time
+    forward, so the next conditional download gets the new body.
+    '''
+    with open(path, "r") as source:
+        changed = int(sum(1 for line in source) * share)
+    with open(path, "r") as source, open(path + ".new", "w") as target:
+        for position, line in enumerate(source):
+            target.write(line if position >= changed else random_ip(rng) + "\n")
+    modified = os.stat(path).st_mtime + 60
+    os.replace(path + ".new", path)
+    os.utime(path, (modified, modified))
+
+
+def reset_peak_rss():
+    '''
+    Resets the peak resident set size of this process so each stage reports its own peak. Needs Linux 4.0 or newer;
+    elsewhere the peak is the one of the whole process.
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(stage, addresses, commands, function):
+    '''
+    Runs one pipeline stage and returns its result together with a report of wall time, peak RSS, the external
+    commands it ran and the lines it sent them.
+    '''
+    metrics.reset()
+    commands.reset_counts()
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = function()
+    report = {"addresses": addresses, "stage": stage, "seconds": round(time.perf_counter() - start, 4),
+              "peak_rss_mb": round(peak_rss_mb(), 1), "commands": dict(commands.calls),
+              "input_lines": sum(commands.input_lines.values())}
+    logging.info("%s addresses, %s: %s seconds", str(addresses), stage, str(report["seconds"]))
+    return result, report
+
+
+def restore_snapshot(config, backend, commands):
+    '''
+    "main.py --restore-snapshot" on a freshly booted kernel, checked against the state the snapshot was taken from.
+    '''
+    saved = commands.state()
+    commands.reboot()
+    if not backend.restore_snapshot(os.path.join(config["path"], config["ip_block"])):
+        raise RuntimeError("The boot snapshot was not restored")
+    if commands.state() != saved:
+        raise RuntimeError("The restored boot snapshot differs from the state it was saved from")
+
+
+def check(config, rng):
+    index = BlockFile(os.path.join(config["path"], config["ip_index"]))
+    try:
+        return sum(1 for position in range(CHECK_LOOKUPS) if index.lookup(rng.getrandbits(32)))
+    finally:
+        index.close()
+
+
+def run_scale(addresses, base_config, backend_name, apply_mode, seed, log_level):
+    '''
+    Runs the whole pipeline for one scale in a scratch directory and returns the stage reports.
+    '''
+    rng = random.Random(seed)
+    commands = RecordingCommands()
+    commands.install()
+    reports = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="phalanx-benchmark-") as directory:
+            feed_directory = os.path.join(directory, "feeds")
+            declared = generate_feeds(feed_directory, addresses, rng)
+            with FeedServer(feed_directory) as server:
+                config = dict(base_config, path=directory, backend=backend_name, apply_mode=apply_mode,
+                              allowlist=[], allowlist_file="", allow_resolvers="False", block_format="binary",
+                              ip_block="ip_blocklist.bin", ip_index="ip_index.bin", WAN0="WAN0", WAN1="WAN1",
+                              MAN="MAN")
+                config["feeds"] = [{"name": feed["name"], "url": server.url + "/" + feed["file"],
+                                    "format": feed["format"]} for feed in declared]
+                fetcher = FeedFetcher(configured_feeds(config), os.path.join(directory, "feed_cache"), log_level)
+                backend = backends[backend_name](config, log_level)
+                stages = [("update", lambda: update_block_list(config, fetcher)),
+                          ("update_unchanged", lambda: update_block_list(config, fetcher)),
+                          ("load_rules", backend.load_rules),
+                          ("apply", lambda: apply_block_list(config, backend)),
+                          ("change_feed", lambda: change_feed(os.path.join(feed_directory, "talos.txt"),
+                                                              CHANGED_SHARE, rng)),
+                          ("update_changed", lambda: update_block_list(config, fetcher)),
+                          ("apply_changed", lambda: apply_block_list(config, backend)),
+                          ("restore_snapshot", lambda: restore_snapshot(config, backend, commands)),
+                          ("check", lambda: check(config, rng))]
+                snapshot = os.path.join(directory, config.get("snapshot", "boot_snapshot") + ".json")
+                for stage, function in stages:
+                    if stage == "restore_snapshot" and not os.path.exists(snapshot):
+                        logging.info("No boot snapshot in apply_mode %s, skipping %s", apply_mode, stage)
+                        continue
+                    report = measure(stage, addresses, commands, function)[1]
+                    if stage != "change_feed":
+                        reports.append(report)
+    finally:
+        commands.uninstall()
+    return reports
+
+
+def print_table(reports):
+    print("addresses\tstage\tseconds\tpeak RSS MB\tcommands\tinput lines")
+    for report in reports:
+        print(str(report["addresses"]) + "\t" + report["stage"] + "\t" + str(report["seconds"]) + "\t" +
+              str(report["peak_rss_mb"]) + "\t" +
+              (",".join(name + "=" + str(count) for name, count in sorted(report["commands"].items())) or "-") +
+              "\t" + str(report["input_lines"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="Phalanx benchmark", description="Runs the update and apply pipeline on \
+                                     synthetic feeds served locally against a recording fake firewall, without root.")
+    parser.add_argument("--scales", dest="scales", default=DEFAULT_SCALES,
+                        help="Comma separated numbers of feed addresses, default " + DEFAULT_SCALES + ".")
+    parser.add_argument("--backend", dest="backend", default="iptables", choices=sorted(backends))
+    parser.add_argument("--apply-mode", dest="apply_mode", default="delta", choices=["rebuild", "swap", "delta"])
+    parser.add_argument("--seed", dest="seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--json", dest="json", metavar="FILE", help="Also write the stage reports to FILE as JSON.")
+    parser.add_argument("-v", "--verbosity", dest="verbosity", help="Increase output verbosity", action="store_true",
+                        default=False)
+    args = parser.parse_args()
+
+    log_level = logging.INFO if args.verbosity else logging.WARN
+    logging.basicConfig(format='%(asctime)s,%(levelname)s,%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
+                        level=log_level)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"), "r") as file:
+        base_config = json.load(file)
+    reports = []
+    for addresses in [int(scale) for scale in args.scales.split(",")]:
+        reports.extend(run_scale(addresses, base_config, args.backend, args.apply_mode, args.seed, log_level))
+    print_table(reports)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(reports, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import IpRanges
+from bisect import bisect_right
+
+BLOCK_FILE_MAGIC = b"PHXBLOCK"
+BLOCK_FILE_VERSION = 1
+FLAG_SOURCES = 1
+# magic, version, flags, IPv4 record count, IPv6 record count, metadata length, SHA-256 of metadata and records.
+HEADER = struct.Struct("<8sHHIII32s")
+# Records are little endian (network, prefix) pairs; IPv6 networks are split into high and low 64 bit halves. Files
+# with FLAG_SOURCES carry a 32 bit feed bitmask after the prefix.
+RECORDS = {(4, False): struct.Struct("<IB"), (4, True): struct.Struct("<IBI"),
+           (6, False): struct.Struct("<QQB"), (6, True): struct.Struct("<QQBI")}
+
+
+class BlockFile:
+    '''
+    Read-only view of a binary block list file. The file is memory mapped and its records are decoded straight from
+    the mapping, so opening it costs a checksum pass instead of a JSON parse, and lookups binary search the mapping
+    without loading the records at all.
+    '''
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            raise ValueError(path + " is not a Phalanx block file")
+        magic, version, flags, ipv4_count, ipv6_count, metadata_length, checksum = HEADER.unpack_from(self.data, 0)
+        if magic != BLOCK_FILE_MAGIC:
+            raise ValueError(path + " is not a Phalanx block file")
+        if version != BLOCK_FILE_VERSION:
+            raise ValueError("Unsupported block file version " + str(version))
+        sources = bool(flags & FLAG_SOURCES)
+        self.records = {4: RECORDS[(4, sources)], 6: RECORDS[(6, sources)]}
+        self.counts = {4: ipv4_count, 6: ipv6_count}
+        metadata_end = HEADER.size + metadata_length
+        self.offsets = {4: metadata_end, 6: metadata_end + ipv4_count * self.records[4].size}
+        end = self.offsets[6] + ipv6_count * self.records[6].size
+        if len(self.data) != end or hashlib.sha256(memoryview(self.data)[HEADER.size:end]).digest() != checksum:
+            raise ValueError(path + " is truncated or corrupt")
+        self.metadata = json.loads(bytes(self.data[HEADER.size:metadata_end]) or b"{}")
+        self.feeds = self.metadata.get("feeds", [])
+        self.sources = sources
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.counts[4] + self.counts[6]
+
+    def record(self, version, position):
+        record = self.records[version]
+        return record.unpack_from(self.data, self.offsets[version] + position * record.size)
+
+    def network(self, version, record):
+        if version == 6:
+            return (record[0] << 64 | record[1]) + IpRanges.IPV6_OFFSET, record[2]
+        return record[0], record[1]
+
+    def blocks(self, version=None):
+        '''
+        Yields (network, prefix) pairs for one family, or for both in ascending order, straight from the mapping.
+        '''
+        for family in ((4, 6) if version is None else (version,)):
+            start = self.offsets[family]
+            view = memoryview(self.data)[start:start + self.counts[family] * self.records[family].size]
+            for record in self.records[family].iter_unpack(view):
+                yield self.network(family, record)
+
+    def block_list(self):
+        '''
+        Decodes the records into an IpRanges.BlockList.
+        '''
+        return IpRanges.BlockList.from_ranges((network, block_end(network, prefix))
+                                              for network, prefix in self.blocks())
+
+    def lookup(self, ip):
+        '''
+        Returns the names of the feeds blocking ip (["block list"] for files without feed sources), or an empty list
+        when the address is not blocked. Raises ValueError for anything that is not an IP address.
+        '''
+        try:
+            value = IpRanges.ip_to_int(ip.strip()) if isinstance(ip, str) else ip
+        except OSError:
+            raise ValueError("Invalid IP address: " + ip)
+        version = 6 if value >= IpRanges.IPV6_OFFSET else 4
+        keys = RecordKeys(self, version)
+        position = bisect_right(keys, value) - 1
+        if position < 0:
+            return []
+        record = self.record(version, position)
+        if value > block_end(*self.network(version, record)):
+            return []
+        if not self.sources:
+            return ["block list"]
+        return [name for bit, name in enumerate(self.feeds) if record[-1] >> bit & 1]
+
+
+class RecordKeys:
+    '''
+    Sequence of the network keys of one family in a BlockFile, so bisect can search the mapping directly.
+    '''
+    def __init__(self, block_file, version):
+        self.block_file = block_file
+        self.version = version
+
+    def __len__(self):
+        return self.block_file.counts[self.version]
+
+    def __getitem__(self, position):
+        return self.block_file.network(self.version, self.block_file.record(self.version, position))[0]
+
+
+def block_end(network, prefix):
+    '''
+    Returns the last address key of a (network, prefix) block.
+    '''
+    return network + (1 << (IpRanges.family_bits(network)[1] - prefix)) - 1
+
+
+def write_block_file(path, blocks, feeds=None):
+    '''
+    Writes (network, prefix) or, when feeds is given, (network, prefix, feed bitmask) blocks in ascending order to a
+    binary block file. The file is written next to path and renamed over it, so readers never see a partial file.
+    '''
+    sources = feeds is not None
+    packed = {4: [], 6: []}
+    for block in blocks:
+        if block[0] >= IpRanges.IPV6_OFFSET:
+            network = block[0] - IpRanges.IPV6_OFFSET
+            packed[6].append(RECORDS[(6, sources)].pack(network >> 64, network & 0xFFFFFFFFFFFFFFFF, *block[1:]))
+        else:
+            packed[4].append(RECORDS[(4, sources)].pack(*block))
+    metadata = json.dumps({"feeds": feeds}).encode("utf-8") if sources else b""
+    payload = metadata + b"".join(packed[4]) + b"".join(packed[6])
+    header = HEADER.pack(BLOCK_FILE_MAGIC, BLOCK_FILE_VERSION, FLAG_SOURCES if sources else 0, len(packed[4]),
+                         len(packed[6]), len(metadata), hashlib.sha256(payload).digest())
+    with open(path + ".tmp", "wb") as file:
+        file.write(header + payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def write_block_list(block_list, path, file_format="binary"):
+    '''
+    Saves a BlockList as a binary block file, or as the JSON list of CIDR strings when file_format is "json".
+    '''
+    if file_format == "json":
+        block_list.write_json(path)
+    else:
+        write_block_file(path, block_list.blocks())
+
+
+def read_block_list(path):
+    '''
+    Loads a BlockList from a binary block file or, for files written before the binary format, a JSON list.
+    '''
+    with open(path, "rb") as file:
+        magic = file.read(len(BLOCK_FILE_MAGIC))
+    if magic != BLOCK_FILE_MAGIC:
+        return IpRanges.BlockList.read_json(path)
+    block_file = BlockFile(path)
+    try:
+        return block_file.block_list()
+    finally:
+        block_file.close()
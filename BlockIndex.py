@@ -0,0 +1,122 @@
+import IpRanges
+from array import array
+from bisect import bisect_right
+from BlockFile import write_block_file
+
+MAX_FEEDS = 32
+
+
+class BlockIndex:
+    '''
+    Lookup index answering "is this address blocked, and by which feeds?" without touching the kernel. The union of
+    all feeds is cut into disjoint segments, each carrying a bitmask of the feeds that list it, stored as sorted
+    start/end arrays (IPv4) or lists (IPv6) so a lookup is one binary search.
+    '''
+    def __init__(self, feeds, starts=None, ends=None, sources=None, ipv6_starts=None, ipv6_ends=None,
+                 ipv6_sources=None):
+        self.feeds = list(feeds)
+        self.starts = starts if starts is not None else array(IpRanges.ADDRESS_TYPECODE)
+        self.ends = ends if ends is not None else array(IpRanges.ADDRESS_TYPECODE)
+        self.sources = sources if sources is not None else array(IpRanges.ADDRESS_TYPECODE)
+        self.ipv6_starts = ipv6_starts if ipv6_starts is not None else []
+        self.ipv6_ends = ipv6_ends if ipv6_ends is not None else []
+        self.ipv6_sources = ipv6_sources if ipv6_sources is not None else []
+
+    @classmethod
+    def build(cls, feed_ranges, excluded=(), weights=None, threshold=1):
+        '''
+        Builds the index from a dictionary of feed name to (start, end) ranges with a single sweep over the sorted
+        range boundaries. Feeds whose ranges are None (failed downloads) are skipped, and the sorted disjoint excluded
+        ranges are subtracted from every feed so the index matches the block list. When weights maps feed names to
+        weights (1 by default), only segments whose feeds add up to at least threshold are kept.
+        '''
+        feeds = [name for name, ranges in feed_ranges.items() if ranges is not None]
+        if len(feeds) > MAX_FEEDS:
+            raise ValueError("The block index supports at most " + str(MAX_FEEDS) + " feeds")
+        feed_weights = [(weights or {}).get(name, 1) for name in feeds]
+        events = []
+        for bit, name in enumerate(feeds):
+            for start, end in IpRanges.subtract_ranges(IpRanges.merge_ranges(feed_ranges[name]), excluded):
+                events.append((start, 1 << bit))
+                events.append((end + 1, 1 << bit))
+        # Never let a segment run from the top of the IPv4 space into the IPv6 space.
+        events.append((IpRanges.IPV6_OFFSET, 0))
+        events.sort()
+        index = cls(feeds)
+        mask = 0
+        weight = 0
+        for position, (boundary, bit) in enumerate(events):
+            if bit:
+                weight += -feed_weights[bit.bit_length() - 1] if mask & bit else feed_weights[bit.bit_length() - 1]
+            mask ^= bit
+            if position + 1 < len(events) and events[position + 1][0] == boundary:
+                continue
+            if mask and weight >= threshold and position + 1 < len(events):
+                index.append(boundary, events[position + 1][0] - 1, mask)
+        return index
+
+    def append(self, start, end, mask):
+        if start < IpRanges.IPV6_OFFSET:
+            starts, ends, sources = self.starts, self.ends, self.sources
+        else:
+            starts, ends, sources = self.ipv6_starts, self.ipv6_ends, self.ipv6_sources
+        if ends and ends[-1] + 1 == start and sources[-1] == mask:
+            ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+            sources.append(mask)
+
+    def lookup(self, ip):
+        '''
+        Returns the names of the feeds blocking ip, which is empty when the address is not blocked. Raises ValueError
+        for anything that is not an IP address.
+        '''
+        try:
+            value = IpRanges.ip_to_int(ip.strip()) if isinstance(ip, str) else ip
+        except OSError:
+            raise ValueError("Invalid IP address: " + ip)
+        if value < IpRanges.IPV6_OFFSET:
+            starts, ends, sources = self.starts, self.ends, self.sources
+        else:
+            starts, ends, sources = self.ipv6_starts, self.ipv6_ends, self.ipv6_sources
+        position = bisect_right(starts, value) - 1
+        if position < 0 or ends[position] < value:
+            return []
+        return [name for bit, name in enumerate(self.feeds) if sources[position] >> bit & 1]
+
+    def segments(self):
+        '''
+        Yields (start, end, mask) segments in ascending order, IPv4 first.
+        '''
+        yield from zip(self.starts, self.ends, self.sources)
+        yield from zip(self.ipv6_starts, self.ipv6_ends, self.ipv6_sources)
+
+    def block_list(self):
+        '''
+        Returns the addresses covered by the index as an IpRanges.BlockList.
+        '''
+        return IpRanges.BlockList.from_ranges((start, end) for start, end, mask in self.segments())
+
+    def write(self, path):
+        '''
+        Saves the index as a binary block file whose records carry the feed bitmask of their segment. "main.py --check"
+        opens it with BlockFile.BlockFile and searches the mapping instead of loading it back into an index.
+        '''
+        write_block_file(path, ((network, prefix, mask) for start, end, mask in self.segments()
+                                for network, prefix in IpRanges.range_to_cidrs(start, end)), self.feeds)
+
+
+def check_addresses(index, addresses):
+    '''
+    Looks up every address in an iterable (for example sys.stdin) and yields (address, feeds) pairs. feeds is the list
+    of feeds blocking the address, empty when it is not blocked, or None when the line is not an IP address.
+    '''
+    for address in addresses:
+        address = address.strip()
+        if not address:
+            continue
+        try:
+            yield address, index.lookup(address)
+        except ValueError:
+            yield address, None
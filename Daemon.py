@@ -0,0 +1,144 @@
+import logging
+import os
+import random
+import time
+from ListActions import FeedFetcher, configured_feeds
+from Metrics import metrics
+from Pipeline import apply_block_list, block_list_path, build_block_list, fetch_feeds, save_block_list
+
+DEFAULT_REFRESH_INTERVAL = 3600
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+JITTER = 0.1
+
+
+class RefreshScheduler:
+    '''
+    Keeps track of when each feed is next due. A successful refresh schedules the feed one interval later, a failed
+    one retries after an exponential backoff. Both delays are jittered so feeds drift apart instead of hitting their
+    servers in lockstep. The daemon uses the same backoff to retry a failed apply.
+    '''
+    def __init__(self, intervals, retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY, jitter=JITTER):
+        self.intervals = intervals
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.jitter = jitter
+        self.next_run = {name: 0 for name in intervals}
+        self.failures = {name: 0 for name in intervals}
+
+    def due(self, now):
+        return [name for name, next_run in self.next_run.items() if next_run <= now]
+
+    def record(self, name, success, now):
+        if success:
+            self.failures[name] = 0
+            delay = self.intervals[name]
+        else:
+            self.failures[name] += 1
+            delay = self.backoff(self.failures[name])
+        self.next_run[name] = now + self.jittered(delay)
+        return self.next_run[name]
+
+    def backoff(self, failures):
+        return min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+
+    def jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def seconds_until_due(self, now):
+        # Without feeds there is nothing to wake up for; idle one default interval instead of spinning.
+        if not self.next_run:
+            return DEFAULT_REFRESH_INTERVAL
+        return max(min(self.next_run.values()) - now, 0)
+
+
+class PhalanxDaemon:
+    '''
+    Resident fetch, aggregate and apply pipeline for "main.py --daemon". Each feed is refreshed on its own interval,
+    its parsed ranges are kept in memory between cycles (seeded from the feed cache on start), and the firewall is only
+    touched when the aggregated block list actually changed.
+    '''
+    def __init__(self, config, backend, log_level):
+        self.config = config
+        self.backend = backend
+        self.block_list_file = block_list_path(config)
+        feeds = configured_feeds(config)
+        self.fetcher = FeedFetcher(feeds, config["path"] + "/" + config.get("feed_cache", "feed_cache"), log_level)
+        default_interval = config.get("refresh_interval", DEFAULT_REFRESH_INTERVAL)
+        self.scheduler = RefreshScheduler({name: config.get("refresh_intervals", {}).get(name, default_interval)
+                                           for name in feeds})
+        self.feed_ranges = {}
+        for name in feeds:
+            cached = self.fetcher.read_cache(name)
+            if cached is not None:
+                self.feed_ranges[name] = cached["ranges"]
+        self.block_list = None
+        self.apply_failures = 0
+        self.retry_apply_at = None
+
+    def run(self):
+        '''
+        Applies the saved block list straight away and then refreshes feeds forever. A failed apply never ends the
+        loop; it is retried with the scheduler's jittered backoff.
+        '''
+        if os.path.exists(self.block_list_file):
+            try:
+                self.block_list = apply_block_list(self.config, self.backend)
+            except Exception as error:
+                self.apply_failed(error, time.time())
+        while True:
+            self.run_once(time.time())
+            try:
+                metrics.write_textfile(self.config, "daemon")
+            except OSError as error:
+                logging.warning("Could not write daemon metrics: %s", error)
+            time.sleep(self.seconds_until_due(time.time()))
+
+    def seconds_until_due(self, now):
+        if self.retry_apply_at is None:
+            return self.scheduler.seconds_until_due(now)
+        return max(min(self.scheduler.seconds_until_due(now), self.retry_apply_at - now), 0)
+
+    def run_once(self, now):
+        '''
+        Refreshes every feed that is due and applies the new block list if it differs from the current one, or retries
+        an apply that failed earlier. Returns True when the firewall was updated.
+        '''
+        due = self.scheduler.due(now)
+        retry = self.retry_apply_at is not None and self.retry_apply_at <= now
+        if not due and not retry:
+            return False
+        if due:
+            logging.info("Refreshing feeds: %s", ", ".join(due))
+            fetched = fetch_feeds(self.fetcher, self.feed_ranges, due)
+            for name in due:
+                self.scheduler.record(name, name in fetched, now)
+        try:
+            index, block_list = build_block_list(self.config, self.fetcher.feeds, self.feed_ranges)
+            if block_list == self.block_list:
+                logging.info("Block list unchanged, firewall left as is")
+                self.retry_apply_at = None
+                return False
+            save_block_list(self.config, index, block_list)
+            apply_block_list(self.config, self.backend, block_list)
+        except Exception as error:
+            # self.block_list keeps the last applied list, so the retry sees the change again.
+            self.apply_failed(error, now)
+            return False
+        metrics.increment("phalanx_daemon_applies_total")
+        self.block_list = block_list
+        self.apply_failures = 0
+        self.retry_apply_at = None
+        logging.info("Applied block list with %s entries", str(len(block_list)))
+        return True
+
+    def apply_failed(self, error, now):
+        '''
+        Schedules a retry of a failed aggregate, write or apply with the same jittered exponential backoff as a failed
+        feed download.
+        '''
+        self.apply_failures += 1
+        delay = self.scheduler.jittered(self.scheduler.backoff(self.apply_failures))
+        self.retry_apply_at = now + delay
+        metrics.increment("phalanx_daemon_apply_failures_total")
+        logging.exception("Applying the block list failed (%s), retrying in %s seconds", error, str(int(delay)))
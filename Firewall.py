@@ -1,30 +1,310 @@
+import abc
+import hashlib
 import ipsetpy
+import json
 import logging
+import os
 import re
 import subprocess
+import IpRanges
+from BlockFile import read_block_list, write_block_file
+from datetime import datetime
+from SetDefaults import FirewallRuleset
+from collections import Counter
+from ipsetpy.exceptions import IpsetCommandHangs, IpsetError, IpsetSetNotFound
+from Metrics import metrics
+
+RESTORE_CHUNK_SIZE = 50000
+RESTORE_TIMEOUT = 60
+MAX_RESTORE_ERRORS = 32
+MIN_SET_SIZE = 64
+restore_error_regex = re.compile("Error in line (\\d+)")
+# ipset family and live set name suffix for IPv4 (4) and IPv6 (6).
+ADDRESS_FAMILIES = {4: ("inet", ""), 6: ("inet6", "-v6")}
+
+
+class FirewallError(Exception):
+    '''
+    Raised by a backend when the kernel rejected its rules or block list, so the caller knows the firewall does not
+    hold what was asked for.
+    '''
+
+
+class FirewallBackend(abc.ABC):
+    '''
+    Interface implemented by every firewall backend. load_rules installs the logging chain and the management
+    interface rules, apply_block_list installs a BlockList as the drop list for traffic forwarded across the bridge.
+    Both raise FirewallError when the kernel rejects part of what they load.
+    '''
+    def __init__(self, config, log_level):
+        self.config = config
+        self.log_level = log_level
+
+    @abc.abstractmethod
+    def load_rules(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def apply_block_list(self, block_list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_state(self):
+        '''
+        Returns the kernel state installed by this backend as a dictionary of snapshot file suffix to contents, or None
+        when it cannot be saved.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_state(self, state):
+        '''
+        Restores a state returned by save_state. Returns True when everything was loaded.
+        '''
+        raise NotImplementedError
+
+    def save_snapshot(self, block_list_file):
+        '''
+        Saves the kernel state after a successful apply so "main.py --restore-snapshot" can put it back at boot in a
+        few calls. The manifest, written last, records the checksum of block_list_file the state was built from and
+        of every state file, so a snapshot is never restored on top of a different block list or half written.
+        '''
+        prefix = os.path.join(self.config["path"], self.config.get("snapshot", "boot_snapshot"))
+        if os.path.exists(prefix + ".json"):
+            os.remove(prefix + ".json")
+        state = self.save_state()
+        if state is None:
+            return False
+        checksums = {}
+        for suffix, content in state.items():
+            write_atomically(prefix + suffix, content)
+            checksums[suffix] = hashlib.sha256(content).hexdigest()
+        manifest = {"backend": type(self).__name__, "block_list_sha256": file_sha256(block_list_file),
+                    "files": checksums}
+        write_atomically(prefix + ".json", json.dumps(manifest, indent=4).encode("utf-8"))
+        logging.info("Saved boot snapshot %s", prefix)
+        return True
+
+    def restore_snapshot(self, block_list_file):
+        '''
+        Restores the snapshot saved by save_snapshot when it was taken by this backend from the current
+        block_list_file. Returns False, leaving the kernel untouched, when the snapshot is missing or stale.
+        '''
+        prefix = os.path.join(self.config["path"], self.config.get("snapshot", "boot_snapshot"))
+        try:
+            with open(prefix + ".json", "r") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            logging.warning("No boot snapshot found at %s", prefix)
+            return False
+        if manifest.get("backend") != type(self).__name__ or \
+                manifest.get("block_list_sha256") != file_sha256(block_list_file):
+            logging.warning("Boot snapshot %s does not match %s, skipping it", prefix, block_list_file)
+            return False
+        state = {}
+        for suffix, checksum in manifest["files"].items():
+            try:
+                with open(prefix + suffix, "rb") as file:
+                    state[suffix] = file.read()
+            except OSError:
+                state[suffix] = None
+            if state[suffix] is None or hashlib.sha256(state[suffix]).hexdigest() != checksum:
+                logging.warning("Boot snapshot file %s is missing or corrupt, skipping the snapshot", prefix + suffix)
+                return False
+        restored = self.load_state(state)
+        if restored:
+            logging.info("Restored boot snapshot %s", prefix)
+        return restored
+
+
+class IptablesBackend(FirewallBackend):
+    '''
+    Default backend built on iptables with physdev matches and ipsets, driven by FirewallRuleset and FirewallIpsets.
+    The last applied block list is kept in memory so a resident process can compute deltas without rereading it.
+    '''
+    def __init__(self, config, log_level):
+        super().__init__(config, log_level)
+        self.applied_block_list = None
+
+    def load_rules(self):
+        '''
+        Brings the LOGGING, INPUT and, outside rebuild mode, FORWARD chains in line with the configuration in a single
+        iptables-restore call, and the ip6tables LOGGING and FORWARD chains in another. The live ipsets are created
+        empty first so the FORWARD rules can reference them before the block list is applied.
+        '''
+        if self.config.get("apply_mode", "rebuild") not in ["swap", "delta"]:
+            if not FirewallRuleset(self.config, self.log_level).apply():
+                raise FirewallError("iptables-restore rejected the default rules")
+            return
+        for family, suffix in ADDRESS_FAMILIES.values():
+            set_name = self.config["ipset_name"] + suffix
+            live_set = FirewallIpsets([], set_name, self.log_level, family)
+            if not live_set.set_exists():
+                live_set.create_ip_set("hash:net")
+            ruleset = FirewallRuleset(self.config, self.log_level, set_name, family)
+            if not ruleset.apply():
+                raise FirewallError(ruleset.iptables + "-restore rejected the default rules")
+
+    def apply_block_list(self, block_list):
+        '''
+        Loads the block list according to apply_mode in the configuration: "rebuild" creates a new set named after the
+        current time and rebuilds the FORWARD chain, "swap" atomically swaps a staging set into the live set and
+        "delta" only applies the entries that changed since the last applied block list. IPv4 and IPv6 entries go to
+        separate live sets, the IPv6 one named after ipset_name with a -v6 suffix and matched by ip6tables. Raises
+        FirewallError, after loading what it could, when entries or rules were rejected.
+        '''
+        apply_mode = self.config.get("apply_mode", "rebuild")
+        if apply_mode in ["swap", "delta"]:
+            applied_block_list = self.config["path"] + "/" + self.config.get("applied_block",
+                                                                             "applied_blocklist.bin")
+            if self.applied_block_list is None and os.path.exists(applied_block_list):
+                self.applied_block_list = read_block_list(applied_block_list)
+            for version, (family, suffix) in ADDRESS_FAMILIES.items():
+                previous = None
+                if apply_mode == "delta" and self.applied_block_list is not None:
+                    previous = self.applied_block_list.family(version)
+                self.apply_live_set(block_list.family(version), previous, self.config["ipset_name"] + suffix, family)
+            write_block_file(applied_block_list, block_list.blocks())
+            self.applied_block_list = block_list
+        else:
+            if block_list.family(6).range_count():
+                logging.warning("IPv6 block list entries are only loaded when apply_mode is swap or delta")
+            block_list = block_list.family(4)
+            run_time = str(datetime.now().strftime("%m/%d/%Y-%H:%M"))
+            FirewallIpsets(block_list, run_time, self.log_level).create_ip_set()
+            rejected = FirewallIpsets(block_list, run_time, self.log_level).convert_block_list_to_ipset()[1]
+            FirewallIpsets(block_list, run_time, self.log_level).delete_old_set()
+            FirewallIpsets(block_list, run_time, self.log_level).reset_chain("FORWARD")
+            FirewallIpsets(block_list, run_time, self.log_level).drop_ipset_traffic("WAN0", "FORWARD", "source")
+            FirewallIpsets(block_list, run_time, self.log_level).drop_ipset_traffic("WAN1", "FORWARD",
+                                                                                    "destination")
+            if rejected:
+                raise FirewallError("IPSet " + run_time + " rejected " + str(len(rejected)) + " entries")
+
+    def save_state(self):
+        '''
+        Saves the live ipsets with "ipset save" and the filter tables with iptables-save and ip6tables-save. Sets
+        named after the load time in rebuild mode are not tracked, so snapshots need apply_mode swap or delta.
+        '''
+        if self.config.get("apply_mode", "rebuild") not in ["swap", "delta"]:
+            logging.info("Boot snapshots need apply_mode swap or delta, not saving one")
+            return None
+        commands = {".ipset": [["ipset", "save", self.config["ipset_name"] + suffix]
+                               for family, suffix in ADDRESS_FAMILIES.values()],
+                    ".iptables": [["iptables-save", "-t", "filter"]],
+                    ".ip6tables": [["ip6tables-save", "-t", "filter"]]}
+        state = {}
+        for suffix, command_list in commands.items():
+            state[suffix] = b""
+            for command in command_list:
+                result = metrics.run(command, capture_output=True)
+                if result.returncode != 0:
+                    logging.error("%s failed: %s", " ".join(command), result.stderr.decode("utf-8").strip())
+                    return None
+                state[suffix] += result.stdout
+        return state
+
+    def load_state(self, state):
+        '''
+        Loads the ipsets in one "ipset restore" call and then each filter table in one iptables-restore call, so the
+        rules never reference a missing set.
+        '''
+        for command, suffix in ((["ipset", "restore", "-exist"], ".ipset"), (["iptables-restore"], ".iptables"),
+                                (["ip6tables-restore"], ".ip6tables")):
+            result = metrics.run(command, input=state[suffix], capture_output=True)
+            if result.returncode != 0:
+                logging.error("%s failed: %s", " ".join(command), result.stderr.decode("utf-8").strip())
+                return False
+        return True
+
+    def apply_live_set(self, block_list, previous, set_name, family):
+        '''
+        Applies the entries that changed since previous to the live set when previous is given and still matches the
+        set, and otherwise rebuilds it atomically, then makes sure the FORWARD rules reference it. A delta that fails
+        or has entries rejected, for example once the set is full, falls back to the rebuild, which sizes a new set.
+        '''
+        live_set = FirewallIpsets(block_list, set_name, self.log_level, family)
+        rejected = None
+        try:
+            # A set recreated empty (for example at boot) no longer matches the snapshot and needs a full load.
+            if previous is not None and live_set.set_header().get("Number of entries") == str(len(previous)):
+                added, removed = IpRanges.diff_block_lists(previous, block_list)
+                rejected = live_set.apply_delta(added, removed)[1]
+                if rejected:
+                    logging.warning("Delta update incomplete, rebuilding IPSet %s", set_name)
+        except (IpsetError, IpsetCommandHangs, OSError, subprocess.SubprocessError) as error:
+            logging.warning("Delta update of IPSet %s failed (%s), rebuilding it", set_name, error)
+            rejected = None
+        if rejected is None or rejected:
+            rejected = live_set.rebuild_atomically()[1]
+        live_set.ensure_drop_ipset_traffic("WAN0", "FORWARD", "source")
+        live_set.ensure_drop_ipset_traffic("WAN1", "FORWARD", "destination")
+        if rejected:
+            raise FirewallError("IPSet " + set_name + " rejected " + str(len(rejected)) + " entries")
 
 
 class FirewallIpsets:
-    def __init__(self, block_list, set_name, log_level):
-        logging.basicConfig(format='%(asctime)s,%(levelname)s,%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
-                            level=log_level)
+    def __init__(self, block_list, set_name, log_level, family="inet"):
         self.block_list = block_list
         self.set_name = set_name
+        self.log_level = log_level
+        self.family = family
+        self.iptables = "ip6tables" if family == "inet6" else "iptables"
 
-    def create_ip_set(self):
+    def create_ip_set(self, set_type=None):
         '''
-        Create ipset based using variables provided to the Class at runtime. Sets length to match the length of the
-        provided list to conserve memory.
+        Create ipset based using variables provided to the Class at runtime. The set type is chosen from the content
+        (hash:ip when every entry is a single host, hash:net otherwise) unless set_type is given, and hashsize and
+        maxelem are sized as integers from the number of entries to conserve memory.
         '''
         logging.debug("Setting IPSet Max Length")
+        if set_type is None:
+            set_type = self.choose_set_type()
+        maxelem = max(len(self.block_list) + len(self.block_list) // 10, MIN_SET_SIZE)
+        # ipset rounds hashsize up to a power of two; keep about four entries per bucket.
+        hashsize = 1 << max((maxelem // 4 - 1).bit_length(), MIN_SET_SIZE.bit_length() - 1)
         try:
             logging.debug("Creating IPSet")
-            ipsetpy.ipset_create_set(self.set_name, "hash:ip", maxelem=len(self.block_list) + \
-                                                                           (len(self.block_list)*float(0.1)))
-            logging.info("IPSet %s Created", str(self.set_name))
-        except:
+            metrics.command("ipset")
+            ipsetpy.ipset_restore_from_command_list(["create " + self.set_name + " " + set_type + " family " +
+                                                     self.family + " hashsize " + str(hashsize) + " maxelem " +
+                                                     str(maxelem) + "\n"])
+            logging.info("IPSet %s Created as %s with hashsize %s and maxelem %s", str(self.set_name), set_type,
+                         str(hashsize), str(maxelem))
+        except IpsetError:
             logging.error("IPSet Already Exists")
 
+    def choose_set_type(self):
+        '''
+        Returns hash:ip when every entry in the block list is a single host and hash:net when it contains CIDRs, and
+        logs the prefix length distribution. hash:net performs one lookup per distinct prefix length.
+        '''
+        host = 128 if self.family == "inet6" else 32
+        prefixes = Counter(int(str(entry).split("/")[1]) if "/" in str(entry) else host for entry in self.block_list)
+        logging.debug("Block list prefix lengths: %s", ", ".join("/" + str(prefix) + ": " + str(count)
+                                                                  for prefix, count in sorted(prefixes.items())))
+        if set(prefixes) <= {host}:
+            return "hash:ip"
+        return "hash:net"
+
+    def current_set_type(self):
+        '''
+        Returns the type of this ipset as loaded in the kernel, or None when the set does not exist.
+        '''
+        return self.set_header().get("Type")
+
+    def set_header(self):
+        '''
+        Returns the header fields of this ipset (Type, Header, Number of entries, ...) as a dictionary, which is empty
+        when the set does not exist.
+        '''
+        try:
+            metrics.command("ipset")
+            header = ipsetpy.ipset_list(self.set_name, terse=True)
+        except IpsetSetNotFound:
+            return {}
+        return dict(line.split(": ", 1) for line in header.splitlines() if ": " in line)
+
     def delete_old_set(self):
         '''
         List all current ipsets in memory and remove old ipsets that are no longer in use.
@@ -32,25 +312,155 @@ class FirewallIpsets:
         name_regex = re.compile("^Name: ")
         count = 0
         logging.debug("Searching current IPSet Names")
+        metrics.command("ipset")
         for ip_set in ipsetpy.ipset_list().splitlines():
             if re.search(name_regex, str(ip_set)):
                 if ip_set.split(" ")[1] != self.set_name:
                     count = count + 1
                     logging.debug("Deleting old IPSet: %s", ip_set.split(" ")[1])
+                    metrics.command("ipset")
                     ipsetpy.ipset_destroy_set(ip_set.split(" ")[1])
         if count == 1:
             logging.info("Removed %s unused IPSet", str(count))
         else:
             logging.info("Removed %s unused IPSets", str(count))
 
-    def convert_block_list_to_ipset(self):
+    def convert_block_list_to_ipset(self, chunk_size=RESTORE_CHUNK_SIZE):
+        '''
+        Streams the provided list into the previously created ipset through "ipset restore" in chunks of chunk_size
+        entries, so the whole list costs a handful of ipset processes instead of one per entry. Returns the number of
+        entries added and the list of rejected entries.
+        '''
+        added, rejected = self.restore_entries([("add", str(entry)) for entry in self.block_list], chunk_size)
+        logging.info("Added %s IP addresses to IPSet Name: %s", str(added), str(self.set_name))
+        return added, rejected
+
+    def apply_delta(self, added, removed, chunk_size=RESTORE_CHUNK_SIZE):
+        '''
+        Adds and deletes only the entries that changed since the last applied block list, in the same restore batch.
+        Additions go first so an entry that was split into smaller blocks is never missing from the set. Returns the
+        number of applied operations and the list of rejected entries.
+        '''
+        applied, rejected = self.restore_entries([("add", entry) for entry in added] +
+                                                 [("del", entry) for entry in removed], chunk_size)
+        logging.info("Applied %s additions and %s deletions to IPSet Name: %s", str(len(added)), str(len(removed)),
+                     str(self.set_name))
+        return applied, rejected
+
+    def restore_entries(self, operations, chunk_size=RESTORE_CHUNK_SIZE):
         '''
-        Loops through provided list and adds each IP address to the previously created ipset.
+        Sends (operation, entry) pairs to this ipset through "ipset restore" in chunks of chunk_size lines. ipset
+        restore stops at the first line it cannot apply and keeps the lines before it. The failing entry is recorded
+        as rejected and the rest of the batch is split in half and resent, so a batch with many bad lines costs
+        O(n log n) lines instead of one resend per rejection. After MAX_RESTORE_ERRORS errors in a chunk the entries
+        not sent yet are rejected as well. Returns the number of applied operations and the list of rejected entries.
         '''
-        for ip in self.block_list:
-            logging.debug("Adding %s to %s", str(ip), str(self.set_name))
-            ipsetpy.ipset_add_entry(self.set_name, ip, exist=True)
-        logging.info("Added %s IP addresses to IPSet Name: %s", str(len(self.block_list)),str(self.set_name))
+        applied = 0
+        rejected = []
+        for start in range(0, len(operations), chunk_size):
+            batches = [operations[start:start + chunk_size]]
+            errors = 0
+            while batches:
+                batch = batches.pop()
+                if errors >= MAX_RESTORE_ERRORS:
+                    rejected.extend(entry for operation, entry in batch)
+                    continue
+                failed_entry = self.restore_batch(batch)
+                if failed_entry is None:
+                    applied = applied + len(batch)
+                    continue
+                errors = errors + 1
+                if failed_entry < 0:
+                    rejected.extend(entry for operation, entry in batch)
+                    continue
+                applied = applied + failed_entry
+                rejected.append(batch[failed_entry][1])
+                remainder = batch[failed_entry + 1:]
+                # Popped last, so the first half is sent first and the operation order is kept.
+                middle = (len(remainder) + 1) // 2
+                batches.extend(half for half in (remainder[middle:], remainder[:middle]) if half)
+            if errors >= MAX_RESTORE_ERRORS:
+                logging.error("ipset restore failed %s times for %s, rejecting the rest of the batch",
+                              str(errors), self.set_name)
+        metrics.increment("phalanx_ipset_operations_total", applied, family=self.family)
+        metrics.increment("phalanx_ipset_rejected_total", len(rejected), family=self.family)
+        if rejected:
+            logging.warning("IPSet %s rejected %s entries: %s", str(self.set_name), str(len(rejected)),
+                            ", ".join(rejected[:10]))
+        return applied, rejected
+
+    def restore_batch(self, batch):
+        '''
+        Runs one "ipset restore" for a batch of (operation, entry) pairs. The input is handed to communicate(), which
+        copes with ipset exiting before it has read everything. Returns None when every line was applied, the position
+        of the line ipset stopped at, or -1 when the failure cannot be pinned on a line.
+        '''
+        commands = "".join(operation + " " + self.set_name + " " + entry + " -exist\n" for operation, entry in batch)
+        try:
+            result = metrics.run(["ipset", "restore"], input=commands.encode("utf-8"), capture_output=True,
+                                 timeout=RESTORE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.error("ipset restore timed out for %s", self.set_name)
+            return -1
+        if result.returncode == 0:
+            return None
+        error = result.stderr.decode("utf-8", "replace").strip()
+        failed_line = re.search(restore_error_regex, error)
+        if failed_line is None or not 0 < int(failed_line.group(1)) <= len(batch):
+            logging.error("ipset restore failed for %s: %s", self.set_name, error)
+            return -1
+        logging.debug("ipset restore stopped for %s: %s", self.set_name, error)
+        return int(failed_line.group(1)) - 1
+
+    def rebuild_atomically(self):
+        '''
+        Replaces the contents of this (live) ipset with the provided list without ever leaving it empty: the list is
+        loaded into a staging set which is then swapped in with ipset swap. The set is created and loaded directly
+        when it does not exist yet. A live hash:net set is kept as hash:net since it holds single hosts as well.
+        '''
+        live_type = self.current_set_type()
+        if live_type is None:
+            self.create_ip_set()
+            return self.convert_block_list_to_ipset()
+        staging_set = FirewallIpsets(self.block_list, self.set_name + "-staging", self.log_level, self.family)
+        staging_set.destroy_ip_set()
+        set_type = "hash:net" if live_type == "hash:net" else self.choose_set_type()
+        staging_set.create_ip_set(set_type)
+        result = staging_set.convert_block_list_to_ipset()
+        if set_type == live_type:
+            staging_set.swap_ip_set(self.set_name)
+        else:
+            staging_set.replace_ip_set(self.set_name, set_type)
+        staging_set.destroy_ip_set()
+        return result
+
+    def replace_ip_set(self, live_set_name, set_type):
+        '''
+        ipset swap only works between sets of the same type. To change the type of the live set, the FORWARD rules are
+        pointed at this loaded staging set first, the live set is recreated empty with the new type, swapped with the
+        staging set and the rules are pointed back, so traffic is matched against a full set throughout.
+        '''
+        logging.info("Changing IPSet %s to %s", live_set_name, set_type)
+        live_set = FirewallIpsets(self.block_list, live_set_name, self.log_level, self.family)
+        self.repoint_rules("FORWARD", live_set_name, self.set_name)
+        live_set.destroy_ip_set()
+        live_set.create_ip_set(set_type)
+        self.swap_ip_set(live_set_name)
+        self.repoint_rules("FORWARD", self.set_name, live_set_name)
+
+    def repoint_rules(self, chain, from_set_name, to_set_name):
+        '''
+        Replaces every rule in chain matching from_set_name with the same rule matching to_set_name. Each new rule is
+        added before the old one is deleted.
+        '''
+        rules = metrics.run([self.iptables, "-S", chain], capture_output=True).stdout.decode("utf-8").splitlines()
+        for rule in rules:
+            rule = rule.split(" ")
+            if rule[0] == "-A" and "--match-set" in rule and rule[rule.index("--match-set") + 1] == from_set_name:
+                new_rule = list(rule[1:])
+                new_rule[new_rule.index("--match-set") + 1] = to_set_name
+                metrics.run([self.iptables, "-A"] + new_rule)
+                metrics.run([self.iptables, "-D"] + rule[1:])
 
     @staticmethod
     def reset_chain(chain):
@@ -58,7 +468,9 @@ class FirewallIpsets:
         Flushes all rules in chain.
         '''
         logging.info("Flushing all iptables rules in %s.", chain)
-        subprocess.run(["iptables", "-F", chain])
+        result = metrics.run(["iptables", "-F", chain], capture_output=True)
+        if result.returncode != 0:
+            raise FirewallError("iptables could not flush " + chain + ": " + result.stderr.decode("utf-8").strip())
 
     def drop_ipset_traffic(self, interface, chain, source_or_destination):
         '''
@@ -66,9 +478,82 @@ class FirewallIpsets:
         '''
         logging.info("Adding rule to %s chain to drop inbound traffic on %s that a %s address in ipset: %s."\
                      , chain, interface, source_or_destination, self.set_name)
+        result = metrics.run([self.iptables, "-A"] + self.drop_rule(interface, chain, source_or_destination),
+                             capture_output=True)
+        if result.returncode != 0:
+            raise FirewallError(self.iptables + " could not add the " + chain + " rule for ipset " + self.set_name +
+                                ": " + result.stderr.decode("utf-8").strip())
+
+    def ensure_drop_ipset_traffic(self, interface, chain, source_or_destination):
+        '''
+        Adds the same rule as drop_ipset_traffic only when iptables -C reports that it is missing, so the chain never
+        has to be flushed to keep the rule current.
+        '''
+        rule = self.drop_rule(interface, chain, source_or_destination)
+        if metrics.run([self.iptables, "-C"] + rule, capture_output=True).returncode == 0:
+            logging.info("Rule dropping %s traffic on %s via ipset %s already in %s.", source_or_destination,
+                         interface, self.set_name, chain)
+        else:
+            self.drop_ipset_traffic(interface, chain, source_or_destination)
+
+    def drop_rule(self, interface, chain, source_or_destination):
+        '''
+        Builds the iptables rule specification matching this ipset on a bridge port.
+        '''
         if source_or_destination == "source":
             direction = "src"
         if source_or_destination == "destination":
             direction = "dst"
-        subprocess.run(["iptables", "-A", chain.upper(), "-m", "set", "--match-set", self.set_name, direction, "-m",\
-                        "physdev", "--physdev-in", interface, "-j" "LOGGING"])
+        return [chain.upper(), "-m", "set", "--match-set", self.set_name, direction, "-m", "physdev", "--physdev-in",
+                interface, "-j", "LOGGING"]
+
+    def set_exists(self):
+        '''
+        Returns True when an ipset with this set name is loaded in the kernel.
+        '''
+        try:
+            metrics.command("ipset")
+            ipsetpy.ipset_list(self.set_name, name=True)
+            return True
+        except IpsetSetNotFound:
+            return False
+
+    def destroy_ip_set(self):
+        '''
+        Removes this ipset from the kernel if it exists.
+        '''
+        if self.set_exists():
+            logging.debug("Destroying IPSet %s", self.set_name)
+            metrics.command("ipset")
+            ipsetpy.ipset_destroy_set(self.set_name)
+
+    def swap_ip_set(self, live_set_name):
+        '''
+        Atomically exchanges the contents of this (staging) ipset with the live ipset referenced by the FORWARD rules.
+        After the swap this set holds the previous block list and can be destroyed.
+        '''
+        logging.info("Swapping IPSet %s into live IPSet %s", self.set_name, live_set_name)
+        metrics.command("ipset")
+        ipsetpy.ipset_swap(self.set_name, live_set_name)
+
+
+def file_sha256(path):
+    '''
+    Returns the SHA-256 hex digest of a file, or None when it cannot be read.
+    '''
+    checksum = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                checksum.update(block)
+    except OSError:
+        return None
+    return checksum.hexdigest()
+
+
+def write_atomically(path, content):
+    with open(path + ".tmp", "wb") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,314 @@
+import json
+import socket
+import struct
+from array import array
+from itertools import chain
+
+ADDRESS_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+# IPv4 and IPv6 addresses share one integer key space: IPv4 addresses are their 32 bit value and IPv6 addresses are
+# their 128 bit value plus IPV6_OFFSET, so every (start, end) range below works for both families and all IPv4
+# ranges sort before all IPv6 ranges.
+IPV6_OFFSET = 1 << 32
+
+# Address space that is not globally routable (ipaddress.IPv4Address.is_global is False for all of it). For IPv6
+# everything outside global unicast 2000::/3 is reserved, plus the special purpose blocks inside it.
+RESERVED_CIDRS = ["0.0.0.0/8", "10.0.0.0/8", "100.64.0.0/10", "127.0.0.0/8", "169.254.0.0/16", "172.16.0.0/12",
+                  "192.0.0.0/29", "192.0.0.170/31", "192.0.2.0/24", "192.168.0.0/16", "198.18.0.0/15",
+                  "198.51.100.0/24", "203.0.113.0/24", "240.0.0.0/4",
+                  "::/3", "4000::/2", "8000::/1", "2001::/23", "2001:db8::/32", "2002::/16"]
+
+
+def ip_to_int(ip):
+    '''
+    Converts an IPv4 or IPv6 address to its integer key.
+    '''
+    if ":" in ip:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big") + IPV6_OFFSET
+    return struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0]
+
+
+def int_to_ip(value):
+    '''
+    Converts an integer key back to an IPv4 or IPv6 address.
+    '''
+    if value >= IPV6_OFFSET:
+        return socket.inet_ntop(socket.AF_INET6, (value - IPV6_OFFSET).to_bytes(16, "big"))
+    return socket.inet_ntop(socket.AF_INET, struct.pack("!I", value))
+
+
+def family_bits(value):
+    '''
+    Returns the key offset and address width of the family an integer key belongs to.
+    '''
+    if value >= IPV6_OFFSET:
+        return IPV6_OFFSET, 128
+    return 0, 32
+
+
+def parse_entry(entry):
+    '''
+    Parses a single IPv4 or IPv6 address, CIDR (a.b.c.d/nn, 2001:db8::/nn) or range (first-last) into an inclusive
+    (start, end) integer key pair. Host bits set in a CIDR are ignored the same way iprange ignores them. Raises
+    ValueError on anything else.
+    '''
+    entry = entry.strip()
+    try:
+        if "/" in entry:
+            address, prefix = entry.split("/", 1)
+            start = ip_to_int(address)
+            offset, bits = family_bits(start)
+            prefix = int(prefix)
+            if not 0 <= prefix <= bits:
+                raise ValueError("Invalid prefix length: " + entry)
+            host_mask = (1 << (bits - prefix)) - 1
+            start = ((start - offset) & ~host_mask) + offset
+            return start, start + host_mask
+        if "-" in entry:
+            first, last = entry.split("-", 1)
+            start, end = ip_to_int(first.strip()), ip_to_int(last.strip())
+            if start > end or family_bits(start) != family_bits(end):
+                raise ValueError("Invalid range: " + entry)
+            return start, end
+        value = ip_to_int(entry)
+        return value, value
+    except OSError:
+        raise ValueError("Invalid IP address: " + entry)
+
+
+def merge_ranges(ranges):
+    '''
+    Sorts (start, end) pairs and merges every overlapping or adjacent pair, returning the minimal list of disjoint
+    ranges in ascending order.
+    '''
+    return list(BlockList.from_ranges(ranges).ranges())
+
+
+def merge_ipv4_keys(keys):
+    '''
+    Merges IPv4 ranges packed as start << 32 | end into two parallel unsigned integer arrays. Packing each pair into
+    one integer sorts several times faster than sorting tuples.
+    '''
+    starts = array(ADDRESS_TYPECODE)
+    ends = array(ADDRESS_TYPECODE)
+    current_end = -2
+    for key in sorted(keys):
+        start, end = key >> 32, key & 0xFFFFFFFF
+        if start <= current_end + 1:
+            if end > current_end:
+                current_end = end
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+            current_end = end
+    return starts, ends
+
+
+def merge_ipv6_pairs(pairs):
+    '''
+    Merges IPv6 (start, end) key pairs into two parallel lists; 128 bit values do not fit in an array.
+    '''
+    starts = []
+    ends = []
+    for start, end in sorted(pairs):
+        if ends and start <= ends[-1] + 1:
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def subtract_ranges(ranges, excluded):
+    '''
+    Removes every address covered by excluded from ranges in a single pass. Both arguments must be sorted, disjoint
+    (start, end) lists as returned by merge_ranges; the result is sorted and disjoint as well.
+    '''
+    result = []
+    excluded_index = 0
+    for start, end in ranges:
+        while excluded_index < len(excluded) and excluded[excluded_index][1] < start:
+            excluded_index += 1
+        index = excluded_index
+        while start <= end and index < len(excluded) and excluded[index][0] <= end:
+            excluded_start, excluded_end = excluded[index]
+            if excluded_start > start:
+                result.append((start, excluded_start - 1))
+            start = max(start, excluded_end + 1)
+            index += 1
+        if start <= end:
+            result.append((start, end))
+    return result
+
+
+def exclusion_ranges(ranges):
+    '''
+    Merges (start, end) ranges that must never be blocked with all non-globally routable address space, ready to be
+    passed to subtract_ranges.
+    '''
+    return merge_ranges(chain(RESERVED_RANGES, ranges))
+
+
+def range_to_cidrs(start, end):
+    '''
+    Splits an inclusive range into the minimal list of (network, prefix) blocks covering it exactly.
+    '''
+    offset, bits = family_bits(start)
+    start, end = start - offset, end - offset
+    cidrs = []
+    while start <= end:
+        # Largest block aligned on start, shrunk until it fits inside the range.
+        size = (start & -start) if start else 1 << bits
+        while start + size - 1 > end:
+            size >>= 1
+        cidrs.append((start + offset, bits + 1 - size.bit_length()))
+        start += size
+    return cidrs
+
+
+def format_cidr(network, prefix):
+    '''
+    Formats a (network, prefix) block the way iprange prints it: single hosts without the /32 or /128 suffix.
+    '''
+    if prefix == family_bits(network)[1]:
+        return int_to_ip(network)
+    return int_to_ip(network) + "/" + str(prefix)
+
+
+def ranges_to_cidrs(ranges):
+    '''
+    Converts sorted disjoint ranges into CIDR strings.
+    '''
+    return [format_cidr(network, prefix) for start, end in ranges for network, prefix in range_to_cidrs(start, end)]
+
+
+def aggregate(entries):
+    '''
+    Parses IP addresses, CIDRs and ranges and returns the minimal CIDR cover of their union, matching the output of
+    "iprange --optimize". Blank lines and # comments are skipped.
+    '''
+    ranges = []
+    for entry in entries:
+        entry = str(entry).split("#", 1)[0].strip()
+        if entry:
+            ranges.append(parse_entry(entry))
+    return ranges_to_cidrs(merge_ranges(ranges))
+
+
+class BlockList:
+    '''
+    Sorted, disjoint address ranges. IPv4 ranges are stored as two parallel 32 bit unsigned integer arrays, eight bytes
+    per range instead of a Python string per address; IPv6 ranges are kept as integer key lists. Iterating a BlockList
+    yields its minimal CIDR cover as strings, and len() is the number of those CIDR entries, so it can be handed
+    straight to FirewallIpsets or written to the block list file.
+    '''
+    def __init__(self, starts=None, ends=None, ipv6_starts=None, ipv6_ends=None):
+        self.starts = starts if starts is not None else array(ADDRESS_TYPECODE)
+        self.ends = ends if ends is not None else array(ADDRESS_TYPECODE)
+        self.ipv6_starts = ipv6_starts if ipv6_starts is not None else []
+        self.ipv6_ends = ipv6_ends if ipv6_ends is not None else []
+        self.cidr_count = None
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        '''
+        Builds a BlockList from (start, end) key pairs of either family in any order, removing duplicates and merging
+        overlapping or adjacent ranges.
+        '''
+        ipv4_keys = []
+        ipv6_pairs = []
+        for start, end in ranges:
+            if start < IPV6_OFFSET:
+                ipv4_keys.append(start << 32 | end)
+            else:
+                ipv6_pairs.append((start, end))
+        return cls(*merge_ipv4_keys(ipv4_keys), *merge_ipv6_pairs(ipv6_pairs))
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''
+        Builds a BlockList from IP address, CIDR and range strings.
+        '''
+        return cls.from_ranges(parse_entry(entry) for entry in entries if str(entry).strip())
+
+    @classmethod
+    def read_json(cls, path):
+        '''
+        Loads a block list file written by write_json.
+        '''
+        with open(path, "r") as file:
+            return cls.from_entries(json.load(file))
+
+    def write_json(self, path):
+        '''
+        Saves the CIDR cover as a JSON list of strings.
+        '''
+        with open(path, "w") as file:
+            json.dump(self.cidrs(), file, indent=4)
+
+    def ranges(self):
+        return chain(zip(self.starts, self.ends), zip(self.ipv6_starts, self.ipv6_ends))
+
+    def range_count(self):
+        return len(self.starts) + len(self.ipv6_starts)
+
+    def family(self, version):
+        '''
+        Returns a BlockList holding only the IPv4 (version 4) or IPv6 (version 6) ranges.
+        '''
+        if version == 6:
+            return BlockList(ipv6_starts=self.ipv6_starts, ipv6_ends=self.ipv6_ends)
+        return BlockList(self.starts, self.ends)
+
+    def cidrs(self):
+        return ranges_to_cidrs(self.ranges())
+
+    def blocks(self):
+        '''
+        Yields the CIDR cover as (network, prefix) pairs in ascending order.
+        '''
+        for start, end in self.ranges():
+            yield from range_to_cidrs(start, end)
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            for network, prefix in range_to_cidrs(start, end):
+                yield format_cidr(network, prefix)
+
+    def __eq__(self, other):
+        return isinstance(other, BlockList) and self.starts == other.starts and self.ends == other.ends and \
+            self.ipv6_starts == other.ipv6_starts and self.ipv6_ends == other.ipv6_ends
+
+    def __len__(self):
+        if self.cidr_count is None:
+            self.cidr_count = sum(len(range_to_cidrs(start, end)) for start, end in self.ranges())
+        return self.cidr_count
+
+
+def diff_block_lists(previous, current):
+    '''
+    Compares the CIDR covers of two BlockLists with a single sorted merge and returns the CIDR strings to add and to
+    remove to turn previous into current.
+    '''
+    added = []
+    removed = []
+    previous_blocks = previous.blocks()
+    current_blocks = current.blocks()
+    previous_block = next(previous_blocks, None)
+    current_block = next(current_blocks, None)
+    while previous_block is not None or current_block is not None:
+        if current_block is None or (previous_block is not None and previous_block < current_block):
+            removed.append(format_cidr(*previous_block))
+            previous_block = next(previous_blocks, None)
+        elif previous_block is None or current_block < previous_block:
+            added.append(format_cidr(*current_block))
+            current_block = next(current_blocks, None)
+        else:
+            previous_block = next(previous_blocks, None)
+            current_block = next(current_blocks, None)
+    return added, removed
+
+
+RESERVED_RANGES = merge_ranges(parse_entry(cidr) for cidr in RESERVED_CIDRS)
@@ -1,86 +1,280 @@
 import requests
-import re
-import ipaddress
-import subprocess
+import json
+import os
 import logging
+import time
+import IpRanges
+from concurrent.futures import ThreadPoolExecutor
+from Metrics import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+FETCH_TIMEOUT = 30
+FETCH_RETRIES = 3
+RESOLV_CONF = "/etc/resolv.conf"
 
-class ContactSite:
-    def __init__(self, site_url, log_level):
-        logging.basicConfig(format='%(asctime)s,%(levelname)s,%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
-                            level=log_level)
-        self.response = requests.get(site_url)
-        self.regex_ip = re.compile("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
 
-    def alien_vault(self):
+def configured_feeds(config):
+    '''
+    Returns the feeds declared under "feeds" in the configuration as a dictionary of feed name to Feed. Each entry
+    needs a name, url and format, and may set weight, column and delimiter. Configurations written before the feed
+    registry, with only the dshield, cisco_talos and otx URLs, get those three feeds.
+    '''
+    if "feeds" in config:
+        declared = config["feeds"]
+    else:
+        declared = [{"name": "dshield", "url": config["dshield"], "format": "netblock"},
+                    {"name": "cisco_talos", "url": config["cisco_talos"], "format": "ip_list"},
+                    {"name": "otx", "url": config["otx"], "format": "comment_prefixed"}]
+    feeds = {}
+    for options in declared:
+        feed = Feed(**options)
+        feeds[feed.name] = feed
+    return feeds
+
+
+def excluded_ranges(config):
+    '''
+    Returns the merged (start, end) ranges that are never blocked: all non-globally routable space, the CIDRs listed
+    under allowlist in the configuration, the entries of allowlist_file (one per line, # comments allowed) and, when
+    allow_resolvers is "True", the nameservers in /etc/resolv.conf. The result is subtracted from the union of all
+    feeds in one pass, so a feed listing any of these addresses can never get them blocked.
+    '''
+    entries = list(config.get("allowlist", []))
+    allowlist_file = config.get("allowlist_file", "")
+    if allowlist_file:
+        allowlist_file = os.path.join(config["path"], allowlist_file)
+        try:
+            with open(allowlist_file, "r") as file:
+                entries.extend(line.split("#", 1)[0].strip() for line in file)
+        except FileNotFoundError:
+            logging.debug("No allowlist file at %s", allowlist_file)
+        except OSError as error:
+            logging.warning("Could not read allowlist file %s: %s", allowlist_file, error)
+    if config.get("allow_resolvers", "False") == "True":
+        entries.extend(resolvers())
+    ranges = []
+    for entry in entries:
+        if not entry:
+            continue
+        try:
+            ranges.append(IpRanges.parse_entry(entry))
+        except ValueError:
+            logging.warning("Ignoring invalid allowlist entry: %s", entry)
+    logging.debug("Excluding %s allowlist entries and all reserved address space", str(len(ranges)))
+    return IpRanges.exclusion_ranges(ranges)
+
+
+def resolvers(path=RESOLV_CONF):
+    '''
+    Returns the nameserver addresses in a resolv.conf file, without IPv6 zone indexes.
+    '''
+    try:
+        with open(path, "r") as file:
+            return [line.split()[1].split("%")[0] for line in file
+                    if line.startswith("nameserver") and len(line.split()) > 1]
+    except OSError as error:
+        logging.warning("Could not read nameservers from %s: %s", path, error)
+        return []
+
+
+def ip_list_entry(line, column, delimiter):
+    '''
+    Plain lists with one IP address, CIDR or range per line, like CISCO Talos.
+    '''
+    return line.strip()
+
+
+def comment_prefixed_entry(line, column, delimiter):
+    '''
+    Lists that may contain # comment lines and comments after the address, like the AlienVault reputation list, which
+    follows each IP with a space and a hash comment listing its reputation type, country and GPS coordinates.
+    '''
+    fields = line.split("#", 1)[0].split(None, 1)
+    return fields[0] if fields else ""
+
+
+def netblock_entry(line, column, delimiter):
+    '''
+    Netblock tables like ISC DShield, which lists tab separated network start, network end and prefix length columns
+    in a manner similar to a WHOIS record. Each netblock becomes a single CIDR instead of the addresses inside it.
+    '''
+    columns = line.split("\t")
+    if len(columns) > 2:
+        return columns[0].strip() + "/" + columns[2].strip()
+    return ""
+
+
+def csv_entry(line, column, delimiter):
+    '''
+    Delimited files with the address in the configured column. Lines starting with # are skipped.
+    '''
+    if line.startswith("#"):
+        return ""
+    columns = line.split(delimiter)
+    if len(columns) > column:
+        return columns[column].strip().strip('"')
+    return ""
+
+
+# Feed formats by configuration name. Each function pulls the address entry out of one line of the feed, returning
+# an empty string for lines without one.
+FEED_FORMATS = {"ip_list": ip_list_entry, "comment_prefixed": comment_prefixed_entry, "netblock": netblock_entry,
+                "csv": csv_entry}
+
+
+class Feed:
+    '''
+    A threat feed declared in the configuration. weight counts towards block_threshold when several feeds list the
+    same address; column and delimiter are only used by the csv format.
+    '''
+    def __init__(self, name, url, format, weight=1, column=0, delimiter=","):
+        if format not in FEED_FORMATS:
+            raise ValueError("Unknown format " + str(format) + " for feed " + name + ", expected one of " +
+                             ", ".join(FEED_FORMATS))
+        self.name = name
+        self.url = url
+        self.format = format
+        self.weight = weight
+        self.column = column
+        self.delimiter = delimiter
+
+    def parse(self, lines):
         '''
-        AlienVault posts their IP Reputation list with the IP starting the line followed a space and hash comment. The
-        comment lists the reputation type, country or origin, and GPS coordinates for the IP. This function strips
-        everything out of the line and does a regex match on the IP address. It then validates that the IP is globally
-        routable before appending the IP to the raw list.
+        Generator turning feed lines into (start, end) integer ranges one line at a time, so a feed is never held in
+        memory as text. Lines that do not hold a valid IP address, CIDR or range are skipped.
         '''
-        raw_list = []
-        logging.debug("Downloading list from AlientVault")
-        if self.response.status_code == 200:
-            logging.debug("Successfully connected to AlienVault")
-            for line in str.split(self.response.text, "\n"):
-                if re.search(self.regex_ip, str(line).split(' ')[0]):
-                    if ipaddress.ip_address(str(line).split(' ')[0]).is_global:
-                        raw_list.append(str(line).split(' ')[0])
-                    else:
-                        pass
-            return raw_list
-        if self.response.status_code != 200:
-            logging.error("AlientVault URL returned: %s status code", self.response.status_code)
-
-    def cisco_talos(self):
+        entry_for = FEED_FORMATS[self.format]
+        entries = 0
+        for line in lines:
+            entry = entry_for(line, self.column, self.delimiter)
+            if not entry:
+                continue
+            try:
+                yield IpRanges.parse_entry(entry)
+                entries += 1
+            except ValueError:
+                pass
+        metrics.set("phalanx_feed_entries", entries, feed=self.name)
+
+
+class FeedFetcher:
+    '''
+    Downloads every feed in parallel over one pooled requests session with timeouts and retry/backoff. Each feed is
+    fetched with If-None-Match/If-Modified-Since from the previous response, and the raw body and parsed ranges are
+    cached in cache_dir so an unchanged feed costs one 304 and no parsing.
+    feeds maps a feed name to a Feed.
+    '''
+    def __init__(self, feeds, cache_dir, log_level, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES):
+        self.feeds = feeds
+        self.cache_dir = cache_dir
+        self.log_level = log_level
+        self.timeout = timeout
+        self.cache = {}
+        retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=max(len(feeds), 1), pool_maxsize=max(len(feeds), 1),
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fetch_all(self, names=None):
         '''
-        CISCO Talos posts IP addresses as single lines containing one IP address per line. This function takes each line
-        and does a regex search to validate that the line contains a properly formatted IP address. If the IP address is
-        a globally routable IP address it appends the IP to the end of the Raw list which is returned by the function.
+        Fetches all feeds, or only the feeds listed in names, concurrently. Returns a dictionary of feed name to
+        ranges, or None for feeds that could not be downloaded or parsed.
         '''
-        raw_list = []
-        logging.debug("Downloading list from CISCO Talos")
-        if self.response.status_code == 200:
-            for line in str.split(self.response.text, "\n"):
-                if re.search(self.regex_ip, str(line)):
-                    if ipaddress.ip_address(line).is_global:
-                        raw_list.append(str(line))
-                    else:
-                        pass
-            return raw_list
-        if self.response.status_code != 200:
-            logging.error("CISCO Talos URL returned: %s status code", self.response.status_code)
-
-    def isc_dshield(self):
+        if names is None:
+            names = list(self.feeds)
+        with ThreadPoolExecutor(max_workers=max(len(names), 1)) as executor:
+            futures = {name: executor.submit(self.fetch, name) for name in names}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except requests.exceptions.RequestException as error:
+                logging.warning("Failed to connect to %s: %s", name, error)
+                results[name] = None
+            except OSError as error:
+                logging.warning("Failed to cache %s: %s", name, error)
+                results[name] = None
+            metrics.set("phalanx_feed_up", int(results[name] is not None), feed=name)
+        return results
+
+    def fetch(self, name):
         '''
-        ISC DSheild posts IP addresses in a manner similar to a WHOIS record therefore blocks are lists in netblocks.
-        This takes those netblocks, transforms them into CIDR notation, enumerates all IP addresses within the netblock,
-        and ff the IP address is a globally routable IP address it appends the IP to the end of the Raw list which is
-        returned by the function.
+        Conditionally downloads and parses a single feed, falling back on the cached ranges when the server answers
+        304 Not Modified. The body is streamed through the feed parser and into the cache line by line.
         '''
-        raw_list = []
-        logging.debug("Downloading list from ISC")
-        if self.response.status_code == 200:
-            for line in str.split(self.response.text, "\n"):
-                if re.search(self.regex_ip, str(str.split(line, '\t'))):
-                    for ip in ipaddress.IPv4Network(str.split(line, '\t')[0] + '/' + str.split(line, '\t')[2]):
-                        if ipaddress.ip_address(ip).is_global:
-                            raw_list.append(str(ip))
-                        else:
-                            pass
-            return raw_list
-        if self.response.status_code != 200:
-            logging.error("ISC URL returned: %s status code", self.response.status_code)
-
-
-class CondenseList:
-    def __init__(self, file, log_level):
-        logging.basicConfig(format='%(asctime)s,%(levelname)s,%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
-                            level=log_level)
-        self.file = file
-
-    def compress(self):
-        logging.debug("Sending block list file to iprange to compress and extract CIDRs")
-        ip_range_output = subprocess.run(["/usr/local/bin/iprange", "--optimize", self.file], stdout=subprocess.PIPE)
-        return str(ip_range_output.stdout, "utf-8").splitlines()
+        start = time.perf_counter()
+        feed = self.feeds[name]
+        cached = self.read_cache(name)
+        headers = {}
+        if cached is not None and cached["url"] == feed.url:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        with self.session.get(feed.url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304 and headers:
+                logging.info("%s not modified since last download, using cached list", name)
+                metrics.set("phalanx_feed_bytes", 0, feed=name)
+                metrics.set("phalanx_feed_fetch_seconds", time.perf_counter() - start, feed=name)
+                return cached["ranges"]
+            if response.status_code != 200:
+                logging.error("%s URL returned: %s status code", name, response.status_code)
+                return None
+            body = os.path.join(self.cache_dir, name + ".body")
+            transfer = {"bytes": 0, "seconds": 0.0}
+            body_start = time.perf_counter()
+            with open(body + ".tmp", "wb") as file:
+                ranges = IpRanges.merge_ranges(feed.parse(self.cached_lines(response, file, transfer)))
+            # Parsing is interleaved with the download; the time not spent waiting on the network went to parsing.
+            parse_seconds = time.perf_counter() - body_start - transfer["seconds"]
+            os.replace(body + ".tmp", body)
+        logging.debug("Parsed %s ranges from %s", str(len(ranges)), name)
+        self.write_cache(name, feed.url, response, ranges)
+        metrics.set("phalanx_feed_bytes", transfer["bytes"], feed=name)
+        metrics.set("phalanx_feed_ranges", len(ranges), feed=name)
+        metrics.set("phalanx_feed_fetch_seconds", time.perf_counter() - start, feed=name)
+        metrics.set("phalanx_feed_parse_seconds", parse_seconds, feed=name)
+        return ranges
+
+    @staticmethod
+    def cached_lines(response, file, transfer):
+        '''
+        Yields the decoded lines of a streamed response while copying them to file. transfer collects the number of
+        bytes read and the seconds spent waiting for them.
+        '''
+        lines = response.iter_lines()
+        while True:
+            start = time.perf_counter()
+            line = next(lines, None)
+            transfer["seconds"] += time.perf_counter() - start
+            if line is None:
+                return
+            transfer["bytes"] += len(line) + 1
+            file.write(line + b"\n")
+            yield line.decode(response.encoding or "utf-8", "replace")
+
+    def read_cache(self, name):
+        if name not in self.cache:
+            try:
+                with open(os.path.join(self.cache_dir, name + ".json"), "r") as file:
+                    cached = json.load(file)
+                cached["ranges"] = [tuple(pair) for pair in cached["ranges"]]
+                self.cache[name] = cached
+            except (OSError, ValueError, KeyError):
+                return None
+        return self.cache[name]
+
+    def write_cache(self, name, url, response, ranges):
+        cached = {"url": url, "etag": response.headers.get("ETag"),
+                  "last_modified": response.headers.get("Last-Modified"), "ranges": ranges}
+        path = os.path.join(self.cache_dir, name + ".json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(cached, file)
+        os.replace(path + ".tmp", path)
+        self.cache[name] = cached
+
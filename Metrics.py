@@ -0,0 +1,112 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    '''
+    Counters, gauges and stage timers collected during a run. Every series is a metric name plus optional labels, so
+    the same values can be written as a Prometheus textfile collector file or printed as a JSON summary. Values are
+    recorded once per stage, feed or command, never per block list entry.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.types = {}
+        # Executes the commands passed to run; Benchmark.py swaps in a recording fake.
+        self.runner = subprocess.run
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+            self.types.clear()
+
+    def increment(self, name, value=1, **labels):
+        self.update(name, "counter", labels, lambda current: current + value)
+
+    def set(self, name, value, **labels):
+        self.update(name, "gauge", labels, lambda current: value)
+
+    def update(self, name, metric_type, labels, function):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = function(series.get(key, 0))
+            self.types[name] = metric_type
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Records the wall time of a with block as phalanx_stage_seconds{stage="..."}, also when the block raises.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.set("phalanx_stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def command(self, name):
+        '''
+        Counts one external command run outside of Metrics.run, for example by ipsetpy.
+        '''
+        self.increment("phalanx_subprocess_calls_total", command=name)
+
+    def run(self, args, **kwargs):
+        '''
+        subprocess.run that counts the call by command name.
+        '''
+        self.command(os.path.basename(args[0]))
+        return self.runner(args, **kwargs)
+
+    def as_dict(self):
+        '''
+        Returns the metrics as a dictionary of name to value, or to a dictionary of label string to value for labelled
+        series, for the --stats summary.
+        '''
+        summary = {}
+        with self.lock:
+            for name, series in self.values.items():
+                if list(series) == [()]:
+                    summary[name] = series[()]
+                else:
+                    summary[name] = {",".join(key + "=" + str(value) for key, value in labels): value
+                                     for labels, value in series.items()}
+        return summary
+
+    def textfile(self):
+        '''
+        Formats the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            for name in sorted(self.values):
+                lines.append("# TYPE " + name + " " + self.types[name])
+                for labels, value in sorted(self.values[name].items()):
+                    label_text = ",".join(key + '="' + str(label).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                                          for key, label in labels)
+                    lines.append(name + ("{" + label_text + "}" if label_text else "") + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, config, run):
+        '''
+        Writes the metrics for the node exporter textfile collector to metrics_file from the configuration, with the
+        run ("update", "apply", "daemon", ...) added to the file name so separate runs do not overwrite each other.
+        The file is renamed into place so the collector never reads a partial file.
+        '''
+        base, extension = os.path.splitext(os.path.join(config["path"], config.get("metrics_file", "phalanx.prom")))
+        path = base + "-" + run + extension
+        self.set("phalanx_last_run_timestamp_seconds", time.time())
+        with open(path + ".tmp", "w") as file:
+            file.write(self.textfile())
+        os.replace(path + ".tmp", path)
+
+    def write_json(self, file):
+        json.dump(self.as_dict(), file, indent=4, sort_keys=True)
+        file.write("\n")
+
+
+# Shared by every module of a run.
+metrics = Metrics()
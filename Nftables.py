@@ -0,0 +1,103 @@
+import logging
+import IpRanges
+from Firewall import FirewallBackend, FirewallError
+from Metrics import metrics
+
+
+class NftablesBackend(FirewallBackend):
+    '''
+    Alternative backend built on nftables. The management rules live in an inet table and the block list in an
+    interval set inside a bridge table whose forward chain matches bridge ports directly, so no physdev match is needed.
+    Each table is replaced together with its set contents in a single atomic "nft -f" transaction.
+    '''
+    def load_rules(self):
+        table = self.config.get("nft_table", "phalanx")
+        rules = []
+        logging.info("Allow icmp set to %s in config.", self.config["ALLOW_ICMP"])
+        if self.config["ALLOW_ICMP"] == "True":
+            rules.append('iifname "MAN" meta l4proto icmp accept')
+        for port in self.config["MAN_Dst_Ports"]:
+            rules.append('iifname "MAN" ' + port[0] + ' dport ' + port[1] + ' accept')
+        for port in self.config["MAN_Src_Ports"]:
+            rules.append('iifname "MAN" ' + port[0] + ' sport ' + port[1] + ' accept')
+        # Like the iptables backend, which leaves ip6tables INPUT alone, only IPv4 is dropped so IPv6 neighbour
+        # discovery and management keep working on MAN.
+        rules.append('iifname "MAN" meta nfproto ipv4 jump logging')
+        logging.info("Loading management rules into nftables table inet %s.", table)
+        self.run_transaction("inet", table, [self.logging_chain(),
+                                             self.chain("input", "type filter hook input priority filter; "
+                                                                 "policy accept;", rules)])
+
+    def apply_block_list(self, block_list):
+        table = self.config.get("nft_table", "phalanx")
+        body = []
+        for version, address_type in ((4, "ipv4_addr"), (6, "ipv6_addr")):
+            elements = [IpRanges.int_to_ip(start) if start == end else
+                        IpRanges.int_to_ip(start) + "-" + IpRanges.int_to_ip(end)
+                        for start, end in block_list.family(version).ranges()]
+            block_set = ["    set blocklist_v" + str(version) + " {", "        type " + address_type,
+                         "        flags interval"]
+            if elements:
+                block_set.append("        elements = { " + ",\n            ".join(elements) + " }")
+            block_set.append("    }")
+            body.append("\n".join(block_set))
+            logging.info("Loading %s IPv%s block list ranges into nftables table bridge %s.", str(len(elements)),
+                         str(version), table)
+        rules = ['iifname "WAN0" ip saddr @blocklist_v4 jump logging',
+                 'iifname "WAN1" ip daddr @blocklist_v4 jump logging',
+                 'iifname "WAN0" ip6 saddr @blocklist_v6 jump logging',
+                 'iifname "WAN1" ip6 daddr @blocklist_v6 jump logging']
+        self.run_transaction("bridge", table, body + [self.logging_chain(),
+                                                      self.chain("forward", "type filter hook forward priority filter; "
+                                                                            "policy accept;", rules)])
+
+    def save_state(self):
+        '''
+        Saves both Phalanx tables as "nft list table" output, each preceded by the same declare and delete statements
+        run_transaction uses, so the file replaces the tables in one "nft -f" transaction.
+        '''
+        table = self.config.get("nft_table", "phalanx")
+        ruleset = b""
+        for family in ("inet", "bridge"):
+            result = metrics.run(["nft", "list", "table", family, table], capture_output=True)
+            if result.returncode != 0:
+                logging.error("nft could not list the %s %s table: %s", family, table,
+                              result.stderr.decode("utf-8").strip())
+                return None
+            ruleset += ("table " + family + " " + table + "\ndelete table " + family + " " + table +
+                        "\n").encode("utf-8") + result.stdout
+        return {".nft": ruleset}
+
+    def load_state(self, state):
+        result = metrics.run(["nft", "-f", "-"], input=state[".nft"], capture_output=True)
+        if result.returncode != 0:
+            logging.error("nft rejected the boot snapshot: %s", result.stderr.decode("utf-8").strip())
+        return result.returncode == 0
+
+    @staticmethod
+    def logging_chain():
+        return NftablesBackend.chain("logging", None, ['limit rate 2/minute log prefix "Firewall-Dropped: "', "drop"])
+
+    @staticmethod
+    def chain(name, hook, rules):
+        lines = ["    chain " + name + " {"]
+        if hook is not None:
+            lines.append("        " + hook)
+        lines.extend("        " + rule for rule in rules)
+        lines.append("    }")
+        return "\n".join(lines)
+
+    @staticmethod
+    def run_transaction(family, table, body):
+        '''
+        Replaces the whole table in one nft transaction. The table is declared before it is deleted so the delete
+        never fails on the first run, and nothing is committed if any statement in the file is rejected. Raises
+        FirewallError when nft rejects the transaction, leaving the previous table in place.
+        '''
+        ruleset = "table " + family + " " + table + "\n" + \
+                  "delete table " + family + " " + table + "\n" + \
+                  "table " + family + " " + table + " {\n" + "\n".join(body) + "\n}\n"
+        result = metrics.run(["nft", "-f", "-"], input=ruleset.encode("utf-8"), capture_output=True)
+        if result.returncode != 0:
+            raise FirewallError("nft rejected the " + family + " " + table + " table: " +
+                                result.stderr.decode("utf-8").strip())
@@ -0,0 +1,85 @@
+import logging
+from BlockFile import read_block_list, write_block_list
+from BlockIndex import BlockIndex
+from ListActions import excluded_ranges
+from Metrics import metrics
+
+
+def block_list_path(config):
+    return config["path"] + "/" + config["ip_block"]
+
+
+def fetch_feeds(fetcher, feed_ranges, names=None):
+    '''
+    Fetches the feeds in names, or every feed, and stores their ranges in feed_ranges. A feed that could not be fetched
+    keeps the ranges it already has in feed_ranges or, failing that, its cached ranges, so a feed that is down never
+    drops out of the block list. Returns the names of the feeds that were fetched.
+    '''
+    with metrics.timer("fetch"):
+        fetched = fetcher.fetch_all(names)
+    for name, ranges in fetched.items():
+        if ranges is not None:
+            feed_ranges[name] = ranges
+            continue
+        if name not in feed_ranges:
+            cached = fetcher.read_cache(name)
+            if cached is None:
+                continue
+            feed_ranges[name] = cached["ranges"]
+        logging.warning("Using the last downloaded ranges for %s", name)
+    return [name for name, ranges in fetched.items() if ranges is not None]
+
+
+def build_block_list(config, feeds, feed_ranges):
+    '''
+    Aggregates feed_ranges into a BlockIndex and the block list it covers. The allowlist is read again on every call so
+    edits take effect without restarting the daemon. Returns the index and the block list.
+    '''
+    input_ranges = sum(len(ranges) for ranges in feed_ranges.values() if ranges is not None)
+    logging.debug("Aggregating %s block list ranges into CIDRs", str(input_ranges))
+    with metrics.timer("aggregate"):
+        index = BlockIndex.build(feed_ranges, excluded_ranges(config),
+                                 {name: feed.weight for name, feed in feeds.items()}, config.get("block_threshold", 1))
+        block_list = index.block_list()
+    metrics.set("phalanx_aggregate_input_ranges", input_ranges)
+    metrics.set("phalanx_block_list_ranges", block_list.range_count())
+    metrics.set("phalanx_block_list_entries", len(block_list))
+    return index, block_list
+
+
+def save_block_list(config, index, block_list):
+    '''
+    Writes the lookup index for "main.py --check" and the block list file.
+    '''
+    with metrics.timer("write"):
+        index.write(config["path"] + "/" + config.get("ip_index", "ip_index.bin"))
+        write_block_list(block_list, block_list_path(config), config.get("block_format", "binary"))
+    logging.info("Compressed block list saved to file:%s", block_list_path(config))
+
+
+def update_block_list(config, fetcher):
+    '''
+    The "main.py --update" run: fetches every feed, aggregates them and saves the block list. Returns the block list.
+    '''
+    feed_ranges = {}
+    fetch_feeds(fetcher, feed_ranges)
+    index, block_list = build_block_list(config, fetcher.feeds, feed_ranges)
+    save_block_list(config, index, block_list)
+    return block_list
+
+
+def apply_block_list(config, backend, block_list=None):
+    '''
+    Applies block_list, read from the block list file when not given, and then saves the boot snapshot. When the
+    backend raises FirewallError the snapshot is left alone, since the kernel does not hold block_list. Returns the
+    applied block list.
+    '''
+    if block_list is None:
+        with metrics.timer("read"):
+            block_list = read_block_list(block_list_path(config))
+    metrics.set("phalanx_block_list_entries", len(block_list))
+    with metrics.timer("apply"):
+        backend.apply_block_list(block_list)
+    with metrics.timer("snapshot"):
+        backend.save_snapshot(block_list_path(config))
+    return block_list
@@ -1,6 +1,6 @@
-import subprocess
 import os, sys
 import logging
+from Metrics import metrics
 
 
 class NetworkSetup:
@@ -11,8 +11,6 @@ class NetworkSetup:
         and mac address. Creates a list of all interfaces that are not loopback or bridges and generates a dictionary
         that is used later to provide information to the user running the script.
         '''
-        logging.basicConfig(format='%(asctime)s,%(levelname)s,%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
-                            level=log_level)
         if not os.geteuid()==0:
             sys.exit("This must be run as root.")
         raw_odd_links = []
@@ -20,7 +18,7 @@ class NetworkSetup:
         self.links_joined = []
         self.links = {}
         logging.debug("Getting list of interfaces from the system.")
-        get_links = subprocess.run(["ip", "link"], capture_output=True)
+        get_links = metrics.run(["ip", "link"], capture_output=True)
         raw_links = str(get_links.stdout.decode("utf-8")).split("\n")
         for i in range(0, len(raw_links)):
              if i % 2:
@@ -46,11 +44,11 @@ class NetworkSetup:
     @staticmethod
     def rename_int_name(interface, name):
         logging.warning("Shutting down interface %s.", interface)
-        subprocess.run(["ip", "link", "set", interface, "down"])
+        metrics.run(["ip", "link", "set", interface, "down"])
         logging.warning("Renaming interface %s to %s.", interface, name)
-        subprocess.run(["ip", "link", "set", interface, "name", name])
+        metrics.run(["ip", "link", "set", interface, "name", name])
         logging.warning("Interface %s coming online.", name)
-        subprocess.run(["ip", "link", "set", name, "up"])
+        metrics.run(["ip", "link", "set", name, "up"])
 
     @staticmethod
     def bridge_setup_interfaces(interface0, interface1):
@@ -60,19 +58,19 @@ class NetworkSetup:
         logging.debug("Setting bridge interfaces to promiscuous mode.")
         for i in [interface0, interface1]:
             logging.warning("Shutting down interface %s.", i)
-            subprocess.run(["ip", "link", "set", "dev", i, "down"])
+            metrics.run(["ip", "link", "set", "dev", i, "down"])
             logging.debug("Checking if %s is in promiscuous mode.", i)
-            link_promiscuous_check = subprocess.run(["ip", "a", "show", i], capture_output=True)
+            link_promiscuous_check = metrics.run(["ip", "a", "show", i], capture_output=True)
             if "PROMISC" in str(link_promiscuous_check.stdout.decode("utf-8")).split(","):
                 logging.debug("%s: Already in promiscuous mode.", i)
             else:
-                subprocess.run(["ip", "link", "set", i, "promisc", "on"])
+                metrics.run(["ip", "link", "set", i, "promisc", "on"])
             logging.debug("Creating bridge")
-            subprocess.run(["ip", "link", "add", "name", "br0", "type", "bridge"])
-            subprocess.run(["ip", "link", "set", "dev", "br0", "up"])
-            subprocess.run(["ip", "link", "set", "dev", i, "master", "br0"])
+            metrics.run(["ip", "link", "add", "name", "br0", "type", "bridge"])
+            metrics.run(["ip", "link", "set", "dev", "br0", "up"])
+            metrics.run(["ip", "link", "set", "dev", i, "master", "br0"])
             logging.warning("Interface %s coming online.", i)
-            subprocess.run(["ip", "link", "set", "dev", i, "up"])
+            metrics.run(["ip", "link", "set", "dev", i, "up"])
 
     def bridge_setup(self):
         '''
@@ -111,67 +109,79 @@ class NetworkSetup:
         return self.links[wan0]["name"], self.links[wan1]["name"], self.links[management]["name"]
 
 
-class FirewallSetup:
+class FirewallRuleset:
     '''
-    Ensure logging is properly setup and default rules are configured for managment interface.
+    Declarative filter table ruleset holding the LOGGING chain, the management INPUT rules and, when set_name is
+    given, the FORWARD drop rules for that ipset. Rules are written in iptables-save format so they can be compared
+    with one iptables-save snapshot, and every chain that differs is rewritten in a single iptables-restore call.
+    For the inet6 family the ruleset goes through ip6tables and only holds the LOGGING and FORWARD chains.
     '''
-    def __init__(self, log_level):
-        logging.basicConfig(format='%(asctime)s,%(levelname)s,%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
-                            level=log_level)
-        self.list_iptables_rules = subprocess.run(["iptables", "-S"], capture_output=True)
-
-    def setup_logging_chain(self):
-        logging.info("Checking for iptables Logging Chain.")
-        if "-N LOGGING" not in self.list_iptables_rules.stdout.decode("utf-8"):
-            logging.info("Adding iptables Logging Chain.")
-            subprocess.run(["iptables", "-N", "LOGGING"])
-        else:
-            logging.info("Logging Chain already in iptables.")
-        if "-m limit" not in self.list_iptables_rules.stdout.decode("utf-8"):
-            logging.info("Adding iptables Logging rate limit.")
-            subprocess.run(["iptables", "-A", "LOGGING", "-m", "limit", "--limit", "2/min", "-j", "LOG",\
-                            "--log-prefix", "Firewall-Dropped: "])
-        else:
-            logging.info("Logging rate limit already in iptables.")
-        if "-A LOGGING -j DROP" not in self.list_iptables_rules.stdout.decode("utf-8"):
-            logging.info("Adding iptables Logging default drop rule.")
-            subprocess.run(["iptables", "-A", "LOGGING", "-j", "DROP"])
-        else:
-            logging.info("Logging default drop rule already in iptables.")
+    def __init__(self, config, log_level, set_name=None, family="inet"):
+        self.iptables = "ip6tables" if family == "inet6" else "iptables"
+        self.chains = {"LOGGING": ['-m limit --limit 2/min -j LOG --log-prefix "Firewall-Dropped: "', "-j DROP"]}
+        if family == "inet":
+            self.chains["INPUT"] = self.management_rules(config)
+        if set_name is not None:
+            self.chains["FORWARD"] = ["-m set --match-set " + set_name + " src -m physdev --physdev-in WAN0 -j LOGGING",
+                                      "-m set --match-set " + set_name + " dst -m physdev --physdev-in WAN1 -j LOGGING"]
 
     @staticmethod
-    def reset_chain(chain):
+    def management_rules(config):
+        input_rules = []
+        if config["ALLOW_ICMP"] == "True":
+            input_rules.append("-i MAN -p icmp -j ACCEPT")
+        for port in config["MAN_Dst_Ports"]:
+            input_rules.append("-i MAN -p " + port[0] + " -m " + port[0] + " --dport " + port[1] + " -j ACCEPT")
+        for port in config["MAN_Src_Ports"]:
+            input_rules.append("-i MAN -p " + port[0] + " -m " + port[0] + " --sport " + port[1] + " -j ACCEPT")
+        input_rules.append("-i MAN -j LOGGING")
+        return input_rules
+
+    def current_rules(self):
         '''
-        Flushes all rules in chain.
+        Reads the filter table once with iptables-save (or ip6tables-save) and returns a dictionary of chain name to
+        its rules.
         '''
-        logging.info("Flushing all iptables rules in %s.", chain)
-        subprocess.run(["iptables", "-F", chain])
+        rules = {}
+        save = metrics.run([self.iptables + "-save", "-t", "filter"], capture_output=True)
+        for line in save.stdout.decode("utf-8").splitlines():
+            if line.startswith(":"):
+                rules.setdefault(line[1:].split(" ")[0], [])
+            elif line.startswith("-A "):
+                chain, rule = line[3:].split(" ", 1)
+                rules.setdefault(chain, []).append(rule)
+        return rules
 
-    def set_management_icmp(self, config_setting):
-        logging.info("Allow icmp set to %s in config.", config_setting)
-        if config_setting == "True":
-            if "-p icmp -j ACCEPT" not in self.list_iptables_rules.stdout.decode("utf-8"):
-                logging.info("Adding rule allowing icmp in iptables.")
-                subprocess.run(["iptables", "-A", "INPUT", "-i", "MAN", "-p", "icmp", "-j", "ACCEPT"])
+    def compile(self, current):
+        '''
+        Builds the iptables-restore input needed to bring the current rules in line with this ruleset, or None when
+        nothing has to change. Missing chains are declared and each differing chain is flushed and rewritten.
+        '''
+        declarations = []
+        commands = []
+        for chain, rules in self.chains.items():
+            if chain not in current:
+                declarations.append(":" + chain + " - [0:0]")
+            elif current[chain] == rules:
+                logging.info("%s chain already up to date in iptables.", chain)
+                continue
             else:
-                logging.info("Rule allowing icmp in already in iptables.")
-
-    def set_management_ports(self, protocol, port, source_or_destination):
-        logging.info("Checking for iptables allows traffic to %s.", port)
-        if source_or_destination == "source":
-            direction = "--sport"
-        if source_or_destination == "destination":
-            direction = "--dport"
-        if "-p " + protocol + " --dport " + port not in self.list_iptables_rules.stdout.decode("utf-8"):
-            logging.info("Adding iptables rule allowing %s/%s.", protocol, port)
-            subprocess.run(["iptables", "-A", "INPUT", "-i", "MAN", "-p", protocol, direction, port, "-j", "ACCEPT"])
-        else:
-            logging.info("Rule allowing traffic via %s/%s already in iptables.", protocol, port)
+                commands.append("-F " + chain)
+            logging.info("Loading %s rules into %s chain.", str(len(rules)), chain)
+            commands.extend("-A " + chain + " " + rule for rule in rules)
+        if not commands and not declarations:
+            return None
+        return "\n".join(["*filter"] + declarations + commands + ["COMMIT"]) + "\n"
 
-    def set_management_default_drop(self):
-        logging.info("Checking if MAN default drop rule is in iptables.")
-        if "-j LOGGING" not in self.list_iptables_rules.stdout.decode("utf-8"):
-            logging.info("Adding MAN default drop rule to iptables.")
-            subprocess.run(["iptables", "-A", "INPUT", "-i", "MAN", "-j", "LOGGING"])
-        else:
-            logging.info("Default drop rule for MAN interface already in iptables.")
\ No newline at end of file
+    def apply(self):
+        '''
+        Applies the ruleset with one iptables-restore --noflush call. Returns True when the rules are in place.
+        '''
+        payload = self.compile(self.current_rules())
+        if payload is None:
+            return True
+        restore = metrics.run([self.iptables + "-restore", "--noflush"], input=payload.encode("utf-8"),
+                                 capture_output=True)
+        if restore.returncode != 0:
+            logging.error("%s-restore failed: %s", self.iptables, restore.stderr.decode("utf-8").strip())
+        return restore.returncode == 0
\ No newline at end of file
@@ -2,15 +2,19 @@ import json
 import logging
 import os
 import argparse
-import requests
-from datetime import datetime
-from ListActions import ContactSite, CondenseList
-from Firewall import FirewallIpsets
-from SetDefaults import NetworkSetup, FirewallSetup
+import sys
+from BlockFile import BlockFile
+from BlockIndex import check_addresses
+from ListActions import FeedFetcher, configured_feeds
+from Daemon import PhalanxDaemon
+from Metrics import metrics
+from Firewall import FirewallError, IptablesBackend
+from Nftables import NftablesBackend
+from Pipeline import apply_block_list, update_block_list
+from SetDefaults import NetworkSetup
 
 config_file = "/opt/phalanx/config.json"
-now = datetime.now()
-run_time = str(now.strftime("%m/%d/%Y-%H:%M"))
+backends = {"iptables": IptablesBackend, "nftables": NftablesBackend}
 
 parser = argparse.ArgumentParser(prog="Phalanx", description="Firewall automation program that builds a transparent \
                                 firewall using publicly available threat feeds.")
@@ -21,6 +25,16 @@ parser.add_argument("-l", "--load-rules", dest="load_rules", \
                     help="Load Default Rules.", action="store_true", default=False)
 parser.add_argument("-u", "--update", dest="update", \
                     help="Update Block-list file.", action="store_true", default=False)
+parser.add_argument("-d", "--daemon", dest="daemon", \
+                    help="Stay resident and refresh feeds and the firewall on a schedule.", action="store_true", \
+                    default=False)
+parser.add_argument("-c", "--check", dest="check", nargs="*", metavar="IP", \
+                    help="Check whether IP addresses are blocked and by which feeds; reads stdin without addresses.")
+parser.add_argument("-r", "--restore-snapshot", dest="restore_snapshot", \
+                    help="Restore the firewall state saved by the last apply, if it matches the block-list file.", \
+                    action="store_true", default=False)
+parser.add_argument("--stats", dest="stats", \
+                    help="Print timings and counters of this run as JSON.", action="store_true", default=False)
 parser.add_argument("-v", "--verbosity", dest="verbosity", \
                     help="Increase output verbosity", action="store_true", default=False)
 parser.add_argument("-vv", "--debug", dest="debug", \
@@ -44,8 +58,28 @@ if not os.path.exists(config_file):
 with open(config_file, 'r') as file:
     config = json.load(file)
     file.close()
+backend = backends[config.get("backend", "iptables")](config, log_level)
+# Setup_Ran is flipped during setup, so decide up front whether this run is one.
+setup = args.setup is True or config["Setup_Ran"] == "False"
+exit_status = 0
 
-if args.setup is True or config["Setup_Ran"] == "False":
+if args.check is not None:
+    index = BlockFile(config["path"] + "/" + config.get("ip_index", "ip_index.bin"))
+    for address, feeds in check_addresses(index, args.check or sys.stdin):
+        if feeds is None:
+            print(address + "\tinvalid")
+        elif feeds:
+            print(address + "\tblocked\t" + ",".join(feeds))
+        else:
+            print(address + "\tnot blocked")
+
+elif args.restore_snapshot is True:
+    with metrics.timer("restore_snapshot"):
+        restored = backend.restore_snapshot(config["path"] + "/" + config["ip_block"])
+    if not restored:
+        logging.warning("Boot snapshot not restored, rules and block list will be loaded in full")
+
+elif setup:
     logging.info("Configuration File Loaded")
     logging.info("Checking config file for interface name.")
     if config["WAN0"] == "" or config["WAN1"] == "":
@@ -72,48 +106,11 @@ if args.setup is True or config["Setup_Ran"] == "False":
         file.close()
 
 elif args.update is True:
-    ip_block_list = config["path"] + "/" + config["ip_block"]
-    dshield_success = True
-    talos_success = True
-    otx_success = False
-    dshield = []
-    talos = []
-    otx = []
-    try:
-        dshield = ContactSite(config['dshield'], log_level).isc_dshield()
-        dshield_success = True
-    except requests.exceptions.ConnectionError:
-        dshield_success = False
-        logging.warning("Failed to connect to dshield.")
-    try:
-        talos = ContactSite(config['cisco_talos'], log_level).cisco_talos()
-        talos_success = True
-    except requests.exceptions.ConnectionError:
-        talos_success = False
-        logging.warning("Failed to connect to CISCO Talos.")
-    try:
-        otx = ContactSite(config['otx'], log_level).alien_vault()
-        otx_success = True
-    except requests.exceptions.ConnectionError:
-        otx_success = False
-        logging.warning("Failed to connect to AlienVault OTX.")
-    union = []
-    for site in ((dshield_success, dshield), (talos_success, talos), (otx_success, otx)):
-        if site[0] is True:
-            union.append(site[1])
-    block_list = set().union(*union)
-    logging.debug("Sorting block list by ip address and saving to file: %s", ip_block_list)
-    with open(ip_block_list, "w") as file:
-        for ip in sorted(block_list, key=lambda ip: (int(ip.split(".")[0]), int(ip.split(".")[1]),\
-                                                     int(ip.split(".")[2]), int(ip.split(".")[3]))):
-            file.write(str(ip) + "\n")
-        file.close()
-    logging.info("Block List saved to file:%s", ip_block_list)
-    compressed_list = CondenseList(ip_block_list, log_level).compress()
-    with open(ip_block_list, "w") as file:
-        logging.info("Compressed block list saved as JSON to file:%s", ip_block_list)
-        json.dump(compressed_list, file, sort_keys=True, indent=4)
-        file.close()
+    cache_dir = config["path"] + "/" + config.get("feed_cache", "feed_cache")
+    update_block_list(config, FeedFetcher(configured_feeds(config), cache_dir, log_level))
+
+elif args.daemon is True:
+    PhalanxDaemon(config, backend, log_level).run()
 
 elif args.load_rules is True:
     for interface in ["WAN0", "WAN1", "MAN"]:
@@ -121,23 +118,32 @@ elif args.load_rules is True:
             NetworkSetup(log_level).rename_int_name(config[interface], interface)
     if NetworkSetup(log_level).check_int_names("br0") is None:
         NetworkSetup(log_level).bridge_setup_interfaces("WAN0", "WAN1")
-    FirewallSetup(log_level).setup_logging_chain()
-    FirewallSetup(log_level).reset_chain("INPUT")
-    FirewallSetup(log_level).set_management_icmp(config["ALLOW_ICMP"])
-    for port in config["MAN_Dst_Ports"]:
-        FirewallSetup(log_level).set_management_ports(port[0], port[1], "destination")
-    for port in config["MAN_Src_Ports"]:
-        FirewallSetup(log_level).set_management_ports(port[0], port[1], "source")
-    FirewallSetup(log_level).set_management_default_drop()
+    try:
+        with metrics.timer("load_rules"):
+            backend.load_rules()
+    except FirewallError as error:
+        logging.error("Loading the default rules failed: %s", error)
+        exit_status = 1
 
 else:
-    ip_block_list = config["path"] + "/" + config["ip_block"]
-    with open(ip_block_list, "r") as file:
-        ips_and_cidrs = json.load(file)
-        file.close()
-    FirewallIpsets(ips_and_cidrs, run_time, log_level).create_ip_set()
-    FirewallIpsets(ips_and_cidrs, run_time, log_level).convert_block_list_to_ipset()
-    FirewallIpsets(ips_and_cidrs, run_time, log_level).delete_old_set()
-    FirewallIpsets(ips_and_cidrs, run_time, log_level).reset_chain("FORWARD")
-    FirewallIpsets(ips_and_cidrs, run_time, log_level).drop_ipset_traffic("WAN0", "FORWARD", "source")
-    FirewallIpsets(ips_and_cidrs, run_time, log_level).drop_ipset_traffic("WAN1", "FORWARD", "destination")
\ No newline at end of file
+    try:
+        apply_block_list(config, backend)
+    except FirewallError as error:
+        logging.error("Applying the block list failed, not saving a boot snapshot: %s", error)
+        exit_status = 1
+
+if metrics.values and args.check is None:
+    if args.restore_snapshot is True:
+        run = "restore_snapshot"
+    elif setup:
+        run = "setup"
+    elif args.update is True:
+        run = "update"
+    elif args.load_rules is True:
+        run = "load_rules"
+    else:
+        run = "apply"
+    metrics.write_textfile(config, run)
+if args.stats is True:
+    metrics.write_json(sys.stdout)
+sys.exit(exit_status)
@@ -0,0 +1,90 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import IpRanges
+from BlockFile import HEADER, BlockFile, read_block_list, write_block_list
+from BlockIndex import BlockIndex
+
+
+class BlockFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "ip_block")
+        self.block_list = IpRanges.BlockList.from_ranges(
+            [IpRanges.parse_entry(entry) for entry in ("8.8.8.0/24", "9.9.9.9", "2001:4860::/32", "2620:fe::fe")])
+
+    def open(self):
+        block_file = BlockFile(self.path)
+        self.addCleanup(block_file.close)
+        return block_file
+
+    def damage(self, change):
+        with open(self.path, "rb") as file:
+            data = bytearray(file.read())
+        with open(self.path, "wb") as file:
+            file.write(change(data))
+
+    def test_round_trip(self):
+        for file_format in ("json", "binary"):
+            write_block_list(self.block_list, self.path, file_format)
+            self.assertEqual(read_block_list(self.path), self.block_list)
+        self.assertEqual(len(self.open()), len(self.block_list))
+
+    def test_corrupt_byte_is_rejected(self):
+        write_block_list(self.block_list, self.path)
+
+        def flip(data):
+            data[-1] ^= 1
+            return data
+        self.damage(flip)
+        with self.assertRaisesRegex(ValueError, "truncated or corrupt"):
+            BlockFile(self.path)
+
+    def test_truncated_file_is_rejected(self):
+        write_block_list(self.block_list, self.path)
+        self.damage(lambda data: data[:-3])
+        with self.assertRaisesRegex(ValueError, "truncated or corrupt"):
+            BlockFile(self.path)
+        self.damage(lambda data: data[:HEADER.size - 1])
+        with self.assertRaisesRegex(ValueError, "not a Phalanx block file"):
+            BlockFile(self.path)
+
+    def test_bad_magic_is_rejected(self):
+        write_block_list(self.block_list, self.path)
+        self.damage(lambda data: b"NOTBLOCK" + data[8:])
+        with self.assertRaisesRegex(ValueError, "not a Phalanx block file"):
+            BlockFile(self.path)
+
+    def test_lookup_without_sources(self):
+        write_block_list(self.block_list, self.path)
+        block_file = self.open()
+        for address, expected in (("8.8.7.255", []), ("8.8.8.0", ["block list"]), ("8.8.8.255", ["block list"]),
+                                  ("8.8.9.0", []), ("9.9.9.9", ["block list"]), ("9.9.9.10", []), ("0.0.0.0", []),
+                                  ("2001:4860:ffff::1", ["block list"]), ("2001:4861::", []), ("::", []),
+                                  ("2620:fe::fe", ["block list"]), ("2620:fe::ff", [])):
+            self.assertEqual(block_file.lookup(address), expected, address)
+        with self.assertRaises(ValueError):
+            block_file.lookup("not an address")
+
+    def test_lookup_matches_index(self):
+        generator = random.Random(20261018)
+        base = IpRanges.ip_to_int("8.8.0.0")
+        feeds = {}
+        for name in ("dshield", "cisco_talos", "otx"):
+            feeds[name] = []
+            for _ in range(20):
+                start = base + generator.randrange(4096)
+                feeds[name].append((start, start + generator.randrange(64)))
+        index = BlockIndex.build(feeds)
+        index.write(self.path)
+        block_file = self.open()
+        self.assertEqual(block_file.feeds, index.feeds)
+        for value in range(base - 16, base + 4096 + 80):
+            self.assertEqual(block_file.lookup(value), index.lookup(value), IpRanges.int_to_ip(value))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import random
+import unittest
+import IpRanges
+from BlockIndex import BlockIndex, check_addresses
+
+BASE = IpRanges.ip_to_int("8.8.0.0")
+IPV6_BASE = IpRanges.ip_to_int("2001:4860::")
+SPAN = 512
+
+
+def random_ranges(generator, base, count):
+    ranges = []
+    for _ in range(count):
+        start = base + generator.randrange(SPAN)
+        ranges.append((start, min(start + generator.randrange(32), base + SPAN - 1)))
+    return ranges
+
+
+class BlockIndexTest(unittest.TestCase):
+    def test_sweep_matches_brute_force(self):
+        generator = random.Random(20261018)
+        for _ in range(30):
+            feeds = {name: random_ranges(generator, BASE, 8) + random_ranges(generator, IPV6_BASE, 4)
+                     for name in ("dshield", "cisco_talos", "otx")}
+            weights = {name: generator.randint(1, 3) for name in feeds}
+            threshold = generator.randint(1, 4)
+            excluded = IpRanges.merge_ranges(random_ranges(generator, BASE, 2))
+            index = BlockIndex.build(feeds, excluded, weights, threshold)
+            for base in (BASE, IPV6_BASE):
+                for value in range(base, base + SPAN):
+                    listed = [name for name, ranges in feeds.items()
+                              if any(start <= value <= end for start, end in ranges) and
+                              not any(start <= value <= end for start, end in excluded)]
+                    expected = listed if sum(weights[name] for name in listed) >= threshold else []
+                    self.assertEqual(index.lookup(value), expected)
+
+    def test_segments_are_disjoint_and_merged(self):
+        index = BlockIndex.build({"a": [IpRanges.parse_entry("8.8.8.0/24")],
+                                  "b": [IpRanges.parse_entry("8.8.8.128/25"), IpRanges.parse_entry("8.8.9.0/24")]})
+        self.assertEqual([(IpRanges.int_to_ip(start), IpRanges.int_to_ip(end), mask)
+                          for start, end, mask in index.segments()],
+                         [("8.8.8.0", "8.8.8.127", 1), ("8.8.8.128", "8.8.8.255", 3), ("8.8.9.0", "8.8.9.255", 2)])
+        self.assertEqual(list(index.block_list()), ["8.8.8.0/23"])
+
+    def test_failed_feeds_are_skipped(self):
+        index = BlockIndex.build({"down": None, "up": [IpRanges.parse_entry("8.8.8.8")]})
+        self.assertEqual(index.feeds, ["up"])
+        self.assertEqual(index.lookup("8.8.8.8"), ["up"])
+
+    def test_top_of_ipv4_does_not_run_into_ipv6(self):
+        index = BlockIndex.build({"a": [IpRanges.parse_entry("255.255.255.255"), IpRanges.parse_entry("::/127")]})
+        self.assertEqual(index.lookup("255.255.255.255"), ["a"])
+        self.assertEqual(index.lookup("::1"), ["a"])
+        self.assertEqual(len(list(index.segments())), 2)
+
+    def test_check_addresses(self):
+        index = BlockIndex.build({"otx": [IpRanges.parse_entry("8.8.8.0/24")]})
+        self.assertEqual(list(check_addresses(index, ["8.8.8.8\n", "\n", "9.9.9.9", "not an address"])),
+                         [("8.8.8.8", ["otx"]), ("9.9.9.9", []), ("not an address", None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import logging
+import os
+import tempfile
+import unittest
+import IpRanges
+from Daemon import DEFAULT_REFRESH_INTERVAL, PhalanxDaemon, RefreshScheduler
+from Firewall import FirewallError
+
+
+class FailingBackend:
+    '''
+    Backend stand-in raising FirewallError from the first failures calls to apply_block_list.
+    '''
+    def __init__(self, failures):
+        self.failures = failures
+        self.applied = []
+        self.snapshots = 0
+
+    def apply_block_list(self, block_list):
+        if self.failures:
+            self.failures -= 1
+            raise FirewallError("nft rejected the bridge phalanx table")
+        self.applied.append(block_list)
+
+    def save_snapshot(self, block_list_file):
+        self.snapshots += 1
+        return True
+
+
+class PhalanxDaemonTest(unittest.TestCase):
+    def daemon(self, backend):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {"path": directory.name, "ip_block": "ip_blocklist.bin", "feeds": [], "allowlist_file": ""}
+        daemon = PhalanxDaemon(config, backend, logging.ERROR)
+        daemon.scheduler = RefreshScheduler({"test": 3600}, jitter=0)
+        daemon.fetcher.fetch_all = lambda names: {name: [IpRanges.parse_entry("8.8.8.0/24")] for name in names}
+        return daemon
+
+    def test_failed_apply_is_retried_with_backoff(self):
+        backend = FailingBackend(2)
+        daemon = self.daemon(backend)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(daemon.run_once(0))
+        self.assertIsNone(daemon.block_list)
+        self.assertEqual((daemon.retry_apply_at, daemon.seconds_until_due(0)), (60, 60))
+        self.assertFalse(daemon.run_once(59))
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(daemon.run_once(60))
+        self.assertEqual(daemon.retry_apply_at, 180)
+        self.assertTrue(daemon.run_once(180))
+        self.assertEqual(len(backend.applied), 1)
+        self.assertEqual(backend.snapshots, 1)
+        self.assertEqual(daemon.block_list, backend.applied[0])
+        self.assertEqual(list(daemon.block_list), ["8.8.8.0/24"])
+        self.assertIsNone(daemon.retry_apply_at)
+        self.assertTrue(os.path.exists(daemon.block_list_file))
+
+    def test_idles_without_feeds(self):
+        self.assertEqual(RefreshScheduler({}).seconds_until_due(0), DEFAULT_REFRESH_INTERVAL)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+import Firewall
+import IpRanges
+from Firewall import FirewallBackend, FirewallError, FirewallIpsets, IptablesBackend
+
+# Stand-in for the ipset binary keeping its sets in a JSON file. Like the real ipset, restore applies lines until the
+# first one it rejects and exits there without reading the rest of stdin. Entries listed in the state's "reject" key
+# and additions beyond maxelem are rejected.
+IPSET_STANDIN = '''
+import json, os, sys
+path = os.environ["PHALANX_TEST_IPSET"]
+with open(path) as file:
+    state = json.load(file)
+state["calls"].append(sys.argv[1:])
+
+def save(status=0, error=None):
+    with open(path, "w") as file:
+        json.dump(state, file)
+    if error:
+        sys.stderr.write("ipset v7.10: " + error + "\\n")
+    sys.exit(status)
+
+def missing(name):
+    if name not in state["sets"]:
+        save(1, "The set with the given name does not exist")
+
+command = sys.argv[1]
+names = [arg for position, arg in enumerate(sys.argv[2:], 2) if not arg.startswith("-") and
+         sys.argv[position - 1] not in ("-output", "-file")]
+if command == "restore":
+    for number, line in enumerate(sys.stdin, 1):
+        words = line.split()
+        if words[0] == "create":
+            maxelem = int(words[words.index("maxelem") + 1]) if "maxelem" in words else 65536
+            state["sets"].setdefault(words[1], {"type": words[2], "maxelem": maxelem, "entries": []})
+            continue
+        if words[1] not in state["sets"]:
+            save(1, "Error in line " + str(number) + ": The set with the given name does not exist")
+        entries = state["sets"][words[1]]["entries"]
+        if words[2] in state["reject"]:
+            save(1, "Error in line " + str(number) + ": Syntax error: '" + words[2] + "' is invalid")
+        if words[0] == "add" and words[2] not in entries:
+            if len(entries) >= state["sets"][words[1]]["maxelem"]:
+                save(1, "Error in line " + str(number) + ": Hash is full, cannot add more elements")
+            entries.append(words[2])
+        elif words[0] == "del" and words[2] in entries:
+            entries.remove(words[2])
+elif command == "list" and not names:
+    sys.stdout.write("".join("Name: " + name + "\\n" for name in state["sets"]))
+elif command == "list":
+    missing(names[0])
+    ip_set = state["sets"][names[0]]
+    sys.stdout.write("Name: " + names[0] + "\\nType: " + ip_set["type"] + "\\nNumber of entries: " +
+                     str(len(ip_set["entries"])) + "\\n")
+elif command == "swap":
+    missing(names[0])
+    missing(names[1])
+    state["sets"][names[0]], state["sets"][names[1]] = state["sets"][names[1]], state["sets"][names[0]]
+elif command == "destroy":
+    missing(names[0])
+    del state["sets"][names[0]]
+save()
+'''
+
+
+class IpsetStandinTest(unittest.TestCase):
+    '''
+    Runs the ipset code against IPSET_STANDIN on PATH, through real pipes. iptables and ip6tables are stubbed to
+    succeed, so every rule counts as already present.
+    '''
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.state_file = os.path.join(directory.name, "ipset.json")
+        with open(os.path.join(directory.name, "ipset"), "w") as file:
+            file.write("#!" + sys.executable + "\n" + IPSET_STANDIN)
+        for stub in ("iptables", "ip6tables"):
+            with open(os.path.join(directory.name, stub), "w") as file:
+                file.write("#!/bin/sh\nexit 0\n")
+        for name in ("ipset", "iptables", "ip6tables"):
+            os.chmod(os.path.join(directory.name, name), 0o755)
+        self.write_state({"sets": {}, "reject": [], "calls": []})
+        environment = {"PATH": directory.name + os.pathsep + os.environ["PATH"],
+                       "PHALANX_TEST_IPSET": self.state_file}
+        previous = {name: os.environ.get(name) for name in environment}
+        os.environ.update(environment)
+        self.addCleanup(self.restore_environment, previous)
+
+    @staticmethod
+    def restore_environment(previous):
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def write_state(self, state):
+        with open(self.state_file, "w") as file:
+            json.dump(state, file)
+
+    def read_state(self):
+        with open(self.state_file) as file:
+            return json.load(file)
+
+    def add_set(self, name, entries, maxelem=65536, reject=()):
+        state = self.read_state()
+        state["sets"][name] = {"type": "hash:net", "maxelem": maxelem, "entries": list(entries)}
+        state["reject"] = list(reject)
+        self.write_state(state)
+
+    @staticmethod
+    def addresses(count, offset=0):
+        return ["10." + str((position + offset) >> 16 & 255) + "." + str((position + offset) >> 8 & 255) + "." +
+                str((position + offset) & 255) for position in range(count)]
+
+    def test_rejected_first_line_reports_rejection(self):
+        entries = self.addresses(5000)
+        self.add_set("test", [], reject=[entries[0], entries[2500]])
+        with self.assertLogs(level="WARNING"):
+            added, rejected = FirewallIpsets(entries, "test", logging.ERROR).convert_block_list_to_ipset()
+        self.assertEqual(added, 4998)
+        self.assertEqual(rejected, [entries[0], entries[2500]])
+        self.assertEqual(sorted(self.read_state()["sets"]["test"]["entries"]),
+                         sorted(entries[1:2500] + entries[2501:]))
+
+    def test_restore_errors_are_capped(self):
+        entries = self.addresses(1000)
+        self.add_set("test", [], reject=entries)
+        with self.assertLogs(level="WARNING"):
+            added, rejected = FirewallIpsets(entries, "test", logging.ERROR).convert_block_list_to_ipset()
+        self.assertEqual((added, sorted(rejected)), (0, sorted(entries)))
+        self.assertEqual(len(self.read_state()["calls"]), Firewall.MAX_RESTORE_ERRORS)
+
+    def test_full_set_falls_back_to_rebuild(self):
+        # Every other address, so no two entries merge into a larger block.
+        keys = [IpRanges.ip_to_int("10.0.0.0") + 2 * position for position in range(150)]
+        previous = IpRanges.BlockList.from_ranges((key, key) for key in keys[:100])
+        current = IpRanges.BlockList.from_ranges((key, key) for key in keys)
+        self.add_set("phalanx", list(previous), maxelem=110)
+        with self.assertLogs(level="WARNING"):
+            IptablesBackend({}, logging.ERROR).apply_live_set(current, previous, "phalanx", "inet")
+        state = self.read_state()
+        self.assertIn(["swap", "phalanx-staging", "phalanx"], state["calls"])
+        self.assertEqual(sorted(state["sets"]), ["phalanx"])
+        self.assertEqual(sorted(state["sets"]["phalanx"]["entries"]), sorted(current))
+
+    def test_rejected_rebuild_raises(self):
+        entries = self.addresses(100)
+        block_list = IpRanges.BlockList.from_ranges(IpRanges.parse_entry(entry) for entry in entries[::2])
+        self.add_set("phalanx", [], reject=[entries[10]])
+        with self.assertLogs(level="WARNING"), self.assertRaises(FirewallError):
+            IptablesBackend({}, logging.ERROR).apply_live_set(block_list, None, "phalanx", "inet")
+        self.assertEqual(len(self.read_state()["sets"]["phalanx"]["entries"]), 49)
+
+
+class MemoryBackend(FirewallBackend):
+    '''
+    Backend whose kernel state is a dictionary, for testing the snapshot manifest.
+    '''
+    def __init__(self, config, state=None):
+        super().__init__(config, logging.ERROR)
+        self.state = state
+        self.loaded = None
+
+    def load_rules(self):
+        pass
+
+    def apply_block_list(self, block_list):
+        pass
+
+    def save_state(self):
+        return self.state
+
+    def load_state(self, state):
+        self.loaded = state
+        return True
+
+
+class OtherBackend(MemoryBackend):
+    pass
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config = {"path": directory.name}
+        self.block_list_file = os.path.join(directory.name, "ip_block")
+        self.manifest = os.path.join(directory.name, "boot_snapshot.json")
+        self.write(self.block_list_file, b"8.8.8.0/24")
+        self.state = {".ipset": b"create phalanx hash:net\n", ".rules": b"*filter\nCOMMIT\n"}
+        self.assertTrue(MemoryBackend(self.config, self.state).save_snapshot(self.block_list_file))
+
+    @staticmethod
+    def write(path, content):
+        with open(path, "wb") as file:
+            file.write(content)
+
+    def restore(self, backend_class=MemoryBackend):
+        backend = backend_class(self.config)
+        with self.assertLogs(level="INFO"):
+            restored = backend.restore_snapshot(self.block_list_file)
+        return restored, backend.loaded
+
+    def test_matching_snapshot_is_restored(self):
+        self.assertEqual(self.restore(), (True, self.state))
+
+    def test_changed_block_list_is_skipped(self):
+        self.write(self.block_list_file, b"9.9.9.0/24")
+        self.assertEqual(self.restore(), (False, None))
+
+    def test_other_backend_is_skipped(self):
+        self.assertEqual(self.restore(OtherBackend), (False, None))
+
+    def test_corrupt_state_file_is_skipped(self):
+        self.write(os.path.join(self.config["path"], "boot_snapshot.rules"), b"*filter\n-A INPUT -j DROP\nCOMMIT\n")
+        self.assertEqual(self.restore(), (False, None))
+
+    def test_missing_state_file_is_skipped(self):
+        os.remove(os.path.join(self.config["path"], "boot_snapshot.ipset"))
+        self.assertEqual(self.restore(), (False, None))
+
+    def test_missing_manifest_is_skipped(self):
+        os.remove(self.manifest)
+        self.assertEqual(self.restore(), (False, None))
+
+    def test_unsaved_state_removes_the_manifest(self):
+        self.assertFalse(MemoryBackend(self.config).save_snapshot(self.block_list_file))
+        self.assertFalse(os.path.exists(self.manifest))
+        self.assertEqual(self.restore(), (False, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
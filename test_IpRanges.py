@@ -0,0 +1,63 @@
+import ipaddress
+import random
+import unittest
+import IpRanges
+
+
+def random_entries(generator, count):
+    '''
+    Returns random IPv4 and IPv6 entries clustered in small networks so that many of them overlap or touch.
+    '''
+    entries = []
+    for _ in range(count):
+        if generator.random() < 0.8:
+            network = ipaddress.IPv4Network((generator.randrange(256) << 24 | generator.randrange(4) << 8, 24),
+                                            strict=False)
+            prefix = generator.randint(network.prefixlen, 32)
+        else:
+            network = ipaddress.IPv6Network((0x20010db8 << 96 | generator.randrange(4) << 64, 64), strict=False)
+            prefix = generator.randint(network.prefixlen, 128)
+        address = network[generator.randrange(network.num_addresses)]
+        entries.append(str(ipaddress.ip_network((address, prefix), strict=False)))
+    return entries
+
+
+class AggregateTest(unittest.TestCase):
+    def test_matches_collapse_addresses(self):
+        generator = random.Random(20261018)
+        for _ in range(50):
+            entries = random_entries(generator, generator.randint(1, 300))
+            networks = [ipaddress.ip_network(entry) for entry in entries]
+            expected = (list(ipaddress.collapse_addresses(n for n in networks if n.version == 4)) +
+                        list(ipaddress.collapse_addresses(n for n in networks if n.version == 6)))
+            # aggregate prints single hosts without a prefix length.
+            actual = [ipaddress.ip_network(cidr) for cidr in IpRanges.aggregate(entries)]
+            self.assertEqual(sorted(actual, key=lambda n: (n.version, n)), expected)
+
+
+class DiffBlockListsTest(unittest.TestCase):
+    def test_diff_turns_previous_into_current(self):
+        generator = random.Random(20261018)
+        for _ in range(50):
+            entries = [IpRanges.parse_entry(entry) for entry in random_entries(generator, 150)]
+            previous = IpRanges.BlockList.from_ranges(entries[:100])
+            current = IpRanges.BlockList.from_ranges(entries[50:])
+            added, removed = IpRanges.diff_block_lists(previous, current)
+            self.assertFalse(set(added) & set(removed))
+            self.assertEqual((set(previous) - set(removed)) | set(added), set(current))
+            self.assertEqual(len(set(previous) - set(removed)) + len(added), len(current))
+
+    def test_unchanged_lists_have_no_diff(self):
+        block_list = IpRanges.BlockList.from_ranges([IpRanges.parse_entry("192.0.2.0/24"),
+                                                     IpRanges.parse_entry("2001:db8::1")])
+        self.assertEqual(IpRanges.diff_block_lists(block_list, IpRanges.BlockList.from_ranges(block_list.ranges())),
+                         ([], []))
+
+    def test_split_block_is_replaced(self):
+        previous = IpRanges.BlockList.from_ranges([IpRanges.parse_entry("192.0.2.0/24")])
+        current = IpRanges.BlockList.from_ranges([IpRanges.parse_entry("192.0.2.0/25")])
+        self.assertEqual(IpRanges.diff_block_lists(previous, current), (["192.0.2.0/25"], ["192.0.2.0/24"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from ListActions import Feed, FeedFetcher
+
+FEED_BODY = b"# test feed\n192.0.2.1\n198.51.100.0/24\n"
+ETAG = '"phalanx-test"'
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    '''
+    Serves FEED_BODY with an ETag, answers a matching If-None-Match with 304 and /broken with 500. Every request is
+    counted per path on the server.
+    '''
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        if self.path == "/broken":
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", str(len(FEED_BODY)))
+            self.end_headers()
+            self.wfile.write(FEED_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FeedFetcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+        cls.server.lock = threading.Lock()
+        cls.server.hits = {}
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:" + str(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.hits.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = directory.name
+
+    def fetcher(self, path, retries=0):
+        feeds = {"test": Feed("test", self.url + path, "ip_list")}
+        fetcher = FeedFetcher(feeds, self.cache_dir, logging.ERROR, timeout=5, retries=retries)
+        # Retry without sleeping between attempts.
+        fetcher.session.get_adapter(self.url).max_retries.backoff_factor = 0
+        return fetcher
+
+    def test_200_writes_cache(self):
+        ranges = self.fetcher("/feed").fetch_all()["test"]
+        self.assertEqual(ranges, [(3221225985, 3221225985), (3325256704, 3325256959)])
+        with open(os.path.join(self.cache_dir, "test.json"), "r") as file:
+            cached = json.load(file)
+        self.assertEqual(cached["etag"], ETAG)
+        self.assertEqual([tuple(pair) for pair in cached["ranges"]], ranges)
+        with open(os.path.join(self.cache_dir, "test.body"), "rb") as file:
+            self.assertEqual(file.read(), FEED_BODY)
+
+    def test_304_reuses_cached_ranges(self):
+        ranges = self.fetcher("/feed").fetch_all()["test"]
+        fetcher = self.fetcher("/feed")
+        with mock.patch.object(Feed, "parse", side_effect=AssertionError("parsed a 304 response")) as parse:
+            self.assertEqual(fetcher.fetch_all()["test"], ranges)
+        parse.assert_not_called()
+        self.assertEqual(self.server.hits["/feed"], 2)
+
+    def test_5xx_retries_then_fails(self):
+        with self.assertLogs(level="WARNING"):
+            self.assertIsNone(self.fetcher("/broken", retries=2).fetch_all()["test"])
+        self.assertEqual(self.server.hits["/broken"], 3)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "test.json")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import logging
+import subprocess
+import unittest
+import IpRanges
+from unittest import mock
+from Firewall import FirewallError
+from Metrics import metrics
+from Nftables import NftablesBackend
+
+CONFIG = {"path": "/nonexistent", "ALLOW_ICMP": "True", "MAN_Dst_Ports": [["tcp", "22"]], "MAN_Src_Ports": []}
+
+
+class NftablesBackendTest(unittest.TestCase):
+    def run_nft(self, returncode):
+        '''
+        Patches Metrics.run so every nft call exits with returncode, and returns the list of recorded calls.
+        '''
+        calls = []
+
+        def runner(args, input=None, **kwargs):
+            calls.append((args, input))
+            return subprocess.CompletedProcess(args, returncode, b"", b"Error: syntax error\n")
+        patcher = mock.patch.object(metrics, "runner", runner)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_rejected_transaction_raises(self):
+        self.run_nft(1)
+        backend = NftablesBackend(CONFIG, logging.ERROR)
+        with self.assertRaises(FirewallError):
+            backend.load_rules()
+        with self.assertRaises(FirewallError):
+            backend.apply_block_list(IpRanges.BlockList.from_ranges([IpRanges.parse_entry("192.0.2.0/24")]))
+
+    def test_management_drop_is_ipv4_only(self):
+        calls = self.run_nft(0)
+        NftablesBackend(CONFIG, logging.ERROR).load_rules()
+        rules = [line.strip() for line in calls[0][1].decode("utf-8").splitlines()]
+        self.assertEqual(rules[rules.index("type filter hook input priority filter; policy accept;") + 1:][:3],
+                         ['iifname "MAN" meta l4proto icmp accept', 'iifname "MAN" tcp dport 22 accept',
+                          'iifname "MAN" meta nfproto ipv4 jump logging'])
+
+    def test_block_list_is_one_transaction(self):
+        calls = self.run_nft(0)
+        NftablesBackend(CONFIG, logging.ERROR).apply_block_list(IpRanges.BlockList.from_ranges(
+            [IpRanges.parse_entry("192.0.2.0/24"), IpRanges.parse_entry("2001:db8::/32")]))
+        self.assertEqual([args for args, input in calls], [["nft", "-f", "-"]])
+        ruleset = calls[0][1].decode("utf-8")
+        self.assertIn("elements = { 192.0.2.0-192.0.2.255 }", ruleset)
+        self.assertIn("elements = { 2001:db8::-2001:db8:ffff:ffff:ffff:ffff:ffff:ffff }", ruleset)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import logging
+import os
+import tempfile
+import unittest
+import IpRanges
+from BlockFile import read_block_list
+from Firewall import FirewallError
+from ListActions import Feed
+from Pipeline import apply_block_list, fetch_feeds, update_block_list
+
+
+class FakeFetcher:
+    '''
+    FeedFetcher stand-in returning fixed results, with None for feeds that are down, and a fixed feed cache.
+    '''
+    def __init__(self, results, cache):
+        self.feeds = {name: Feed(name, "http://127.0.0.1/" + name, "ip_list") for name in results}
+        self.results = results
+        self.cache = cache
+
+    def fetch_all(self, names=None):
+        return {name: self.results[name] for name in (names or self.results)}
+
+    def read_cache(self, name):
+        return self.cache.get(name)
+
+
+class RecordingBackend:
+    def __init__(self, error=None):
+        self.error = error
+        self.applied = []
+        self.snapshots = []
+
+    def apply_block_list(self, block_list):
+        if self.error is not None:
+            raise self.error
+        self.applied.append(block_list)
+
+    def save_snapshot(self, block_list_file):
+        self.snapshots.append(block_list_file)
+        return True
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config = {"path": directory.name, "ip_block": "ip_blocklist.bin", "allowlist_file": ""}
+
+    def test_failed_feed_falls_back_to_cache(self):
+        fetcher = FakeFetcher({"up": [IpRanges.parse_entry("8.8.8.0/24")], "down": None, "new": None},
+                              {"down": {"ranges": [IpRanges.parse_entry("9.9.9.0/24")]}})
+        with self.assertLogs(level="WARNING"):
+            block_list = update_block_list(self.config, fetcher)
+        self.assertEqual(list(block_list), ["8.8.8.0/24", "9.9.9.0/24"])
+        self.assertEqual(read_block_list(os.path.join(self.config["path"], "ip_blocklist.bin")), block_list)
+
+    def test_failed_feed_keeps_ranges_in_memory(self):
+        fetcher = FakeFetcher({"down": None}, {"down": {"ranges": [IpRanges.parse_entry("9.9.9.0/24")]}})
+        feed_ranges = {"down": [IpRanges.parse_entry("8.8.8.0/24")]}
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(fetch_feeds(fetcher, feed_ranges), [])
+        self.assertEqual(feed_ranges, {"down": [IpRanges.parse_entry("8.8.8.0/24")]})
+
+    def test_rejected_apply_skips_snapshot(self):
+        block_list = IpRanges.BlockList.from_ranges([IpRanges.parse_entry("8.8.8.0/24")])
+        backend = RecordingBackend(FirewallError("nft rejected the bridge phalanx table"))
+        with self.assertRaises(FirewallError):
+            apply_block_list(self.config, backend, block_list)
+        self.assertEqual(backend.snapshots, [])
+        backend = RecordingBackend()
+        self.assertEqual(apply_block_list(self.config, backend, block_list), block_list)
+        self.assertEqual(backend.snapshots, [os.path.join(self.config["path"], "ip_blocklist.bin")])
+
+
+if __name__ == "__main__":
+    unittest.main()
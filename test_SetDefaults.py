@@ -0,0 +1,98 @@
+import logging
+import subprocess
+import unittest
+from unittest import mock
+from Metrics import metrics
+from SetDefaults import FirewallRuleset
+
+CONFIG = {"ALLOW_ICMP": "True", "MAN_Dst_Ports": [["tcp", "22"], ["udp", "161"]], "MAN_Src_Ports": [["tcp", "443"]]}
+
+SAVED_RULES = '''# Generated by iptables-save v1.8.9 (nf_tables) on Sun Oct 18 10:00:00 2026
+*filter
+:INPUT ACCEPT [1204:98311]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [877:120455]
+:LOGGING - [0:0]
+-A INPUT -i MAN -p icmp -j ACCEPT
+-A INPUT -i MAN -p tcp -m tcp --dport 22 -j ACCEPT
+-A INPUT -i MAN -p udp -m udp --dport 161 -j ACCEPT
+-A INPUT -i MAN -p tcp -m tcp --sport 443 -j ACCEPT
+-A INPUT -i MAN -j LOGGING
+-A FORWARD -m set --match-set phalanx src -m physdev --physdev-in WAN0 -j LOGGING
+-A FORWARD -m set --match-set phalanx dst -m physdev --physdev-in WAN1 -j LOGGING
+-A LOGGING -m limit --limit 2/min -j LOG --log-prefix "Firewall-Dropped: "
+-A LOGGING -j DROP
+COMMIT
+# Completed on Sun Oct 18 10:00:00 2026
+'''
+
+EMPTY_RULES = '''*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -i eth0 -j ACCEPT
+COMMIT
+'''
+
+
+class FirewallRulesetTest(unittest.TestCase):
+    def run_iptables(self, dump):
+        '''
+        Patches Metrics.run so iptables-save prints dump and iptables-restore succeeds, and returns the recorded calls.
+        '''
+        calls = []
+
+        def runner(args, input=None, **kwargs):
+            calls.append((args, input))
+            stdout = dump.encode("utf-8") if args[0].endswith("-save") else b""
+            return subprocess.CompletedProcess(args, 0, stdout, b"")
+        patcher = mock.patch.object(metrics, "runner", runner)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_saved_rules_compile_to_nothing(self):
+        calls = self.run_iptables(SAVED_RULES)
+        ruleset = FirewallRuleset(CONFIG, logging.ERROR, "phalanx")
+        self.assertIsNone(ruleset.compile(ruleset.current_rules()))
+        self.assertTrue(ruleset.apply())
+        self.assertEqual([args[0] for args, input in calls], ["iptables-save", "iptables-save"])
+
+    def test_missing_and_differing_chains_are_rewritten(self):
+        calls = self.run_iptables(EMPTY_RULES)
+        ruleset = FirewallRuleset(CONFIG, logging.ERROR, "phalanx")
+        self.assertTrue(ruleset.apply())
+        self.assertEqual(calls[-1][0], ["iptables-restore", "--noflush"])
+        payload = calls[-1][1].decode("utf-8").splitlines()
+        self.assertEqual(payload[:2], ["*filter", ":LOGGING - [0:0]"])
+        self.assertIn("-F INPUT", payload)
+        self.assertIn("-F FORWARD", payload)
+        self.assertNotIn("-F LOGGING", payload)
+        self.assertNotIn("-A INPUT -i eth0 -j ACCEPT", payload)
+        self.assertEqual(payload[-1], "COMMIT")
+        # The payload yields exactly the saved ruleset, which compiles to nothing.
+        self.run_iptables(SAVED_RULES)
+        self.assertEqual(sorted(line for line in payload if line.startswith("-A ")),
+                         sorted(line for line in SAVED_RULES.splitlines() if line.startswith("-A ")))
+        self.assertIsNone(ruleset.compile(ruleset.current_rules()))
+
+    def test_ipv6_ruleset_leaves_input_alone(self):
+        calls = self.run_iptables(SAVED_RULES.replace("phalanx", "phalanx6"))
+        ruleset = FirewallRuleset(CONFIG, logging.ERROR, "phalanx6", "inet6")
+        self.assertIsNone(ruleset.compile(ruleset.current_rules()))
+        self.assertEqual(calls[0][0][0], "ip6tables-save")
+        self.assertNotIn("INPUT", ruleset.chains)
+
+    def test_failed_restore_is_reported(self):
+        self.run_iptables(EMPTY_RULES)
+
+        def runner(args, input=None, **kwargs):
+            if args[0] == "iptables-restore":
+                return subprocess.CompletedProcess(args, 1, b"", b"iptables-restore: line 3 failed\n")
+            return subprocess.CompletedProcess(args, 0, EMPTY_RULES.encode("utf-8"), b"")
+        with mock.patch.object(metrics, "runner", runner), self.assertLogs(level="ERROR"):
+            self.assertFalse(FirewallRuleset(CONFIG, logging.ERROR, "phalanx").apply())
+
+
+if __name__ == "__main__":
+    unittest.main()